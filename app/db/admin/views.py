@@ -3,7 +3,8 @@ from sqladmin import ModelView
 
 
 class TaskView(ModelView, model=Task):
-    column_list = "__all__"
+    # Items are not listed, so the page doesn't load every task items
+    column_list = [Task.id, Task.created_at, Task.status, Task.images_count, Task.images_done, Task.error]
     column_searchable_list = [Task.id]
     column_default_sort = [(Task.created_at, True)]
 
@@ -18,6 +18,12 @@ async def _get_channel() -> aio_pika.Channel:
 channel_pool: Pool = Pool(_get_channel, max_size=50)
 
 
+async def get_rabbitmq_publisher_channel() -> aio_pika.abc.AbstractChannel:
+    """Dedicated long-lived channel in publisher confirms mode, raising on unroutable messages"""
+    connection = await _get_connection()
+    return await connection.channel(publisher_confirms=True, on_return_raises=True)
+
+
 async def get_rabbitmq_channel() -> aio_pika.Channel:
     async with channel_pool.acquire() as channel:
         yield channel
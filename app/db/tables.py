@@ -8,6 +8,7 @@ from sqlalchemy import bindparam
 from sqlalchemy import CheckConstraint
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Table
 from sqlalchemy import text
 from sqlalchemy import UniqueConstraint
@@ -18,6 +19,7 @@ from sqlalchemy.orm import mapped_column as column
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import false
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.associationproxy import AssociationProxy
 
@@ -37,11 +39,23 @@ class BaseMixin:
     updated_at: M[dt.datetime | None] = column(nullable=True, onupdate=sql_utcnow)
 
 
+class TaskStatus(str, Enum):
+    pending = "pending"
+    processing = "processing"
+    finished = "finished"
+    failed = "failed"
+
+
 class TaskItem(Base):
     __tablename__ = "task_items"
+    __table_args__ = (
+        Index("ix_task_items_flags", "is_profile", "is_halfprofile", "is_eyes_closed", "is_face_small"),
+        # One row per face of an image, so a redelivered response isn't saved twice
+        Index("ix_task_items_image_face", "task_id", "image_index", "face_index", unique=True),
+    )
 
     id: M[int] = column(primary_key=True, index=True, autoincrement=True)
-    task_id: M[UUID] = column(ForeignKey('tasks.id', ondelete="CASCADE"))
+    task_id: M[UUID] = column(ForeignKey('tasks.id', ondelete="CASCADE"), index=True)
 
     left_eye_close: M[float | None]
     right_eye_close: M[float | None]
@@ -54,6 +68,7 @@ class TaskItem(Base):
     image_width: M[int | None]
     image_height: M[int | None]
     image_index: M[int | None]
+    face_index: M[int | None]
     with_glasses: M[bool | None] = column(server_default=false(), default=False)
     is_face_small: M[bool | None]
     is_profile: M[bool | None]
@@ -65,7 +80,43 @@ class TaskItem(Base):
 
 
 class Task(BaseMixin, Base):
+    __table_args__ = (
+        Index("ix_tasks_created_at_id", "created_at", "id"),
+    )
+
     error: M[str | None] = column(nullable=True)
+    status: M[str] = column(server_default=TaskStatus.pending.value, default=TaskStatus.pending.value)
+    images_count: M[int] = column(server_default="0", default=0)
+    images_done: M[int] = column(server_default="0", default=0)
 
     items: M[list['TaskItem']] = relationship(back_populates='task')
 
+
+class ImageCache(Base):
+    """CV responses of already processed images, keyed by sha256 of the image bytes"""
+    __tablename__ = "image_cache"
+
+    hash: M[str] = column(primary_key=True)
+    filename: M[str] = column(index=True)
+    response: M[list | None] = column(JSONB, nullable=True)
+    created_at: M[dt.datetime] = column(server_default=sql_utcnow)
+    used_at: M[dt.datetime] = column(server_default=sql_utcnow, index=True)
+
+
+class StatsHourly(Base):
+    """Counters rolled up by hour, incremented as tasks, results and votes are written"""
+    __tablename__ = "stats_hourly"
+
+    hour: M[dt.datetime] = column(primary_key=True)
+    tasks: M[int] = column(server_default="0", default=0)
+    images: M[int] = column(server_default="0", default=0)
+    faces: M[int] = column(server_default="0", default=0)
+    faces_not_found: M[int] = column(server_default="0", default=0)
+    processing_failed: M[int] = column(server_default="0", default=0)
+    eyes_closed: M[int] = column(server_default="0", default=0)
+    small_faces: M[int] = column(server_default="0", default=0)
+    profile: M[int] = column(server_default="0", default=0)
+    halfprofile: M[int] = column(server_default="0", default=0)
+    glasses: M[int] = column(server_default="0", default=0)
+    votes_good: M[int] = column(server_default="0", default=0)
+    votes_bad: M[int] = column(server_default="0", default=0)
@@ -10,11 +10,17 @@ from contextlib import asynccontextmanager
 
 from app.db.admin import attach_admin_panel
 from app.repositories.cv import CVRepository
+from app.repositories.image_cache import ImageCacheRepository
+from app.repositories.task_events import TaskEventsRepository
 from app.services.task import TaskService
 
 
 class ProjectSettings(BaseSettings):
     LOCAL_MODE: bool = False
+    RESPONSES_BATCH_SIZE: int = 100
+    RESPONSES_FLUSH_INTERVAL_MS: int = 200
+    RESPONSES_CONCURRENCY: int = 4
+    RESPONSES_PREFETCH: int | None = None
 
 
 def register_exception(application):
@@ -43,7 +49,17 @@ def register_cors(application):
 
 @asynccontextmanager
 async def lifespan(application):
-    asyncio.create_task(CVRepository.listen_responses(TaskService.save_cv_response))
+    project_settings = ProjectSettings()
+    await CVRepository.start_publisher()
+    asyncio.create_task(CVRepository.listen_responses(
+        TaskService.save_cv_responses,
+        batch_size=project_settings.RESPONSES_BATCH_SIZE,
+        flush_interval=project_settings.RESPONSES_FLUSH_INTERVAL_MS / 1000,
+        concurrency=project_settings.RESPONSES_CONCURRENCY,
+        prefetch_count=project_settings.RESPONSES_PREFETCH
+    ))
+    asyncio.create_task(ImageCacheRepository.run_eviction())
+    asyncio.create_task(TaskEventsRepository.listen())
     yield
 
 
@@ -63,9 +79,13 @@ def init_web_application():
 
     from app.routes.task import router as task_router
     from app.routes.web import router as web_router
+    from app.routes.metrics import router as metrics_router
+    from app.routes.stats import router as stats_router
 
     application.include_router(task_router)
     application.include_router(web_router)
+    application.include_router(metrics_router)
+    application.include_router(stats_router)
 
     attach_admin_panel(application)
 
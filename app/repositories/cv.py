@@ -1,35 +1,108 @@
-from fastapi import Depends
 import asyncio
 import json
+import os
 from loguru import logger
-from aio_pika import connect_robust, Message, Queue
+from aio_pika import DeliveryMode, Message
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage
+from fastapi import HTTPException
 from pydantic import BaseModel
 
-from app.db.rabbitmq import get_rabbitmq_queue, channel_pool
+from app.db.rabbitmq import channel_pool, get_rabbitmq_publisher_channel
 from app.schemas.cv import CVResponse, CVRequest
 
 
 class CVRepository:
-    def __init__(
-        self,
-        requests_queue: Queue = Depends(get_rabbitmq_queue("cv_requests")),
-        responses_queue: Queue = Depends(get_rabbitmq_queue("cv_responses"))
-    ):
-        self.requests_queue = requests_queue
-        self.responses_queue = responses_queue
-
-    async def _send(self, filename: str, task_id: str):
-        request = CVRequest(filename=filename, task_id=task_id).model_dump_json()
-        message = Message(
-            body=request.encode(),
-            reply_to=self.responses_queue.name
-        )
-        await self.requests_queue.channel.default_exchange.publish(
-            message, routing_key="cv_requests"
+    """
+    Publishes requests through one long-lived channel per worker,
+    opened and with queues declared once by start_publisher at application startup.
+    The channel is in publisher confirms mode: publish returns after the broker
+    has taken the persistent message and raises if it was nacked or unroutable
+    """
+    REQUESTS_QUEUE = "cv_requests"
+    # Lane for batch submissions, cv workers take it only when there are no interactive requests
+    BULK_REQUESTS_QUEUE = "cv_requests_bulk"
+    RESPONSES_QUEUE = "cv_responses"
+    RESPONSES_DEAD_QUEUE = "cv_responses_dead"
+    # A response failing to be saved is put back to the queue after a growing delay,
+    # so it outlives a short database outage, and is dead lettered after the retries
+    RESPONSE_MAX_RETRIES = int(os.getenv("CV_RESPONSE_MAX_RETRIES", 8))
+    RESPONSE_RETRY_DELAY = float(os.getenv("CV_RESPONSE_RETRY_DELAY", 1))
+    RESPONSE_MAX_RETRY_DELAY = 60.0
+    # Admission control: new tasks are refused while the lane holds more messages
+    MAX_QUEUE_DEPTH = int(os.getenv("CV_MAX_QUEUE_DEPTH", 1000))
+    MAX_BULK_QUEUE_DEPTH = int(os.getenv("CV_MAX_BULK_QUEUE_DEPTH", 20000))
+    RETRY_AFTER = int(os.getenv("CV_RETRY_AFTER", 30))
+    # Queue depth is re-read from the broker at most once per interval
+    DEPTH_CHECK_INTERVAL = 1.0
+    # Images up to this size are sent inside the request, so cv workers don't need the shared volume.
+    # 0 disables inline images
+    INLINE_MAX_SIZE = int(os.getenv("CV_INLINE_MAX_SIZE", 0))
+    # Requests of one submission published at once, bounding inline images held in memory
+    SEND_CONCURRENCY = int(os.getenv("CV_SEND_CONCURRENCY", 16))
+
+    _channel: AbstractChannel | None = None
+    _depths: dict[str, tuple[float, int]] = {}
+
+    @classmethod
+    async def start_publisher(cls):
+        cls._channel = await get_rabbitmq_publisher_channel()
+        await cls._channel.declare_queue(cls.REQUESTS_QUEUE, durable=True)
+        await cls._channel.declare_queue(cls.BULK_REQUESTS_QUEUE, durable=True)
+        await cls._channel.declare_queue(cls.RESPONSES_QUEUE, durable=True)
+
+    async def _get_depth(self, queue_name: str) -> int:
+        loop = asyncio.get_running_loop()
+        checked_at, depth = self._depths.get(queue_name, (None, 0))
+        if checked_at is None or loop.time() - checked_at > self.DEPTH_CHECK_INTERVAL:
+            queue = await self._channel.declare_queue(queue_name, passive=True)
+            depth = queue.declaration_result.message_count
+            self._depths[queue_name] = (loop.time(), depth)
+        return depth
+
+    async def admit(self, bulk: bool = False):
+        """Raise 503 with Retry-After if the requests lane is too deep to take new tasks"""
+        queue_name, max_depth = self.REQUESTS_QUEUE, self.MAX_QUEUE_DEPTH
+        if bulk:
+            queue_name, max_depth = self.BULK_REQUESTS_QUEUE, self.MAX_BULK_QUEUE_DEPTH
+        if self._channel is None:
+            raise RuntimeError("CV requests publisher is not started")
+        depth = await self._get_depth(queue_name)
+        if depth >= max_depth:
+            logger.warning(f"Queue {queue_name} depth {depth} is over {max_depth}, task refused")
+            raise HTTPException(
+                503, detail="Too many images in processing, try again later",
+                headers={"Retry-After": str(self.RETRY_AFTER)}
+            )
+
+    async def send(self, filename: str, task_id: str, image: bytes | None = None, bulk: bool = False):
+        """
+        Request is JSON with the filename to read from the shared images volume,
+        or, if image is given, the JPEG itself as the body with the request fields in headers.
+        Bulk requests go to the lower priority lane
+        """
+        if self._channel is None:
+            raise RuntimeError("CV requests publisher is not started")
+        request = CVRequest(filename=filename, task_id=task_id)
+        if image is not None:
+            message = Message(
+                body=image,
+                content_type="image/jpeg",
+                headers=request.model_dump(),
+                reply_to=self.RESPONSES_QUEUE,
+                delivery_mode=DeliveryMode.PERSISTENT
+            )
+        else:
+            message = Message(
+                body=request.model_dump_json().encode(),
+                reply_to=self.RESPONSES_QUEUE,
+                delivery_mode=DeliveryMode.PERSISTENT
+            )
+        await self._channel.default_exchange.publish(
+            message, routing_key=self.BULK_REQUESTS_QUEUE if bulk else self.REQUESTS_QUEUE, mandatory=True
         )
 
     async def process_image(self, filename: str, task_id: str):
-        await self._send(filename, task_id)
+        await self.send(filename, task_id)
         return
         response = await self._receive()
         logger.debug(f"Response: {response}")
@@ -37,17 +110,127 @@ class CVRepository:
         return response
 
     @classmethod
-    async def listen_responses(cls, callback):
+    async def listen_responses(
+            cls,
+            callback,
+            batch_size: int = 1,
+            flush_interval: float = 0.2,
+            concurrency: int = 1,
+            prefetch_count: int | None = None
+    ):
+        """
+        Buffer responses up to batch_size messages or flush_interval seconds
+        and pass them to callback as one batch, acking the messages after it succeeded.
+        A failed batch is retried message by message, so a bad response doesn't hold back the others.
+        The messages failing alone are republished with the attempts counted in x-retries header
+        after an exponential backoff, and go to cv_responses_dead after RESPONSE_MAX_RETRIES,
+        as do malformed responses.
+        Up to concurrency batches are processed at once.
+
+        Every API worker runs this as a competing consumer of cv_responses:
+        the broker holds at most prefetch_count unacked messages per worker
+        and hands the rest to the others, so a message is processed by exactly one worker.
+        """
+        loop = asyncio.get_running_loop()
+        buffer: asyncio.Queue[AbstractIncomingMessage] = asyncio.Queue()
+        semaphore = asyncio.Semaphore(concurrency)
+        # The event loop keeps only weak references to tasks
+        tasks: set[asyncio.Task] = set()
         async with channel_pool.acquire() as channel:
+            await channel.set_qos(prefetch_count=prefetch_count or batch_size * concurrency)
             queue = await channel.declare_queue(
-                "cv_responses", durable=True
+                cls.RESPONSES_QUEUE, durable=True
             )
+            await channel.declare_queue(cls.RESPONSES_DEAD_QUEUE, durable=True)
+            await queue.consume(buffer.put)
+
+            while True:
+                await semaphore.acquire()
+                messages = [await buffer.get()]
+                deadline = loop.time() + flush_interval
+                while len(messages) < batch_size and (timeout := deadline - loop.time()) > 0:
+                    try:
+                        messages.append(await asyncio.wait_for(buffer.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                task = asyncio.create_task(cls._process_responses(channel, messages, callback, flush_interval))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: semaphore.release())
+
+    @classmethod
+    async def _retry_response(
+            cls, channel: AbstractChannel, message: AbstractIncomingMessage, error: str, dead: bool = False
+    ):
+        """
+        Put the failed response back to the tail of the queue after a backoff,
+        or to the dead letter queue if it's malformed or out of retries, then ack the original.
+        If the republish fails, the original is requeued as it is
+        """
+        headers = dict(message.headers or {})
+        retries = headers.get("x-retries", 0) + 1
+        if dead or retries > cls.RESPONSE_MAX_RETRIES:
+            logger.error(f"Dead lettering response: {error}")
+            queue_name = cls.RESPONSES_DEAD_QUEUE
+            headers.update({"x-error": error, "x-queue": cls.RESPONSES_QUEUE})
+        else:
+            await asyncio.sleep(min(cls.RESPONSE_RETRY_DELAY * 2 ** (retries - 1), cls.RESPONSE_MAX_RETRY_DELAY))
+            queue_name = cls.RESPONSES_QUEUE
+            headers["x-retries"] = retries
+        try:
+            await channel.default_exchange.publish(
+                Message(
+                    body=message.body,
+                    content_type=message.content_type,
+                    headers=headers,
+                    delivery_mode=DeliveryMode.PERSISTENT
+                ),
+                routing_key=queue_name
+            )
+        except Exception as e:
+            logger.exception(e)
+            await message.nack(requeue=True)
+            return
+        await message.ack()
+
+    @classmethod
+    async def _process_responses(
+            cls, channel: AbstractChannel, messages: list[AbstractIncomingMessage], callback, retry_delay: float
+    ):
+        batch, accepted, malformed = [], [], []
+        for message in messages:
+            try:
+                body = json.loads(message.body)
+                batch.append([CVResponse.model_validate(response) for response in body])
+                accepted.append(message)
+            except Exception as e:
+                logger.exception(e)
+                malformed.append(cls._retry_response(channel, message, f"Malformed response: {e}", dead=True))
+        await asyncio.gather(*malformed)
+        if not batch:
+            return
 
-            async with queue.iterator() as queue_iter:
-                async for response in queue_iter:
-                    async with response.process():
-                        body = json.loads(response.body)
-                        logger.debug(body)
-                        body = [CVResponse.model_validate(response) for response in body]
-                        await callback(body)
+        logger.debug(f"Flushing {len(batch)} responses")
+        try:
+            await callback(batch)
+        except Exception as e:
+            logger.exception(e)
+        else:
+            for message in accepted:
+                await message.ack()
+            return
 
+        await asyncio.sleep(retry_delay)
+        failed = []
+        for message, response in zip(accepted, batch):
+            try:
+                await callback([response])
+            except Exception as e:
+                logger.exception(e)
+                logger.warning(f"Retrying response {response}")
+                failed.append(cls._retry_response(channel, message, f"{type(e).__name__}: {e}"))
+                continue
+            await message.ack()
+        # Backoffs of the failed responses run at once
+        await asyncio.gather(*failed)
@@ -1,28 +1,190 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+import asyncio
+import hashlib
 import os
 import pathlib
+import time
+from uuid import uuid4
 
-from PIL import Image, ImageDraw
+from fastapi import HTTPException, UploadFile
+from PIL import ExifTags, Image, ImageDraw, ImageOps, UnidentifiedImageError
+
+
+class ImageProcessingPool:
+    """
+    Bounded thread pool for CPU-bound PIL work, so it doesn't block the event loop.
+    PIL releases the GIL while decoding and encoding, so threads run in parallel.
+    Collects queue depth and latency metrics by operation
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image")
+        self.in_flight = 0
+        self.stats: dict[str, dict[str, float]] = {}
+
+    async def run(self, operation: str, func, *args):
+        submitted_at = time.perf_counter()
+        started_at = None
+        self.in_flight += 1
+
+        def call():
+            nonlocal started_at
+            started_at = time.perf_counter()
+            return func(*args)
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, call)
+        finally:
+            self.in_flight -= 1
+            finished_at = time.perf_counter()
+            stats = self.stats.setdefault(
+                operation, {"count": 0, "wait_seconds": 0.0, "run_seconds": 0.0, "max_seconds": 0.0}
+            )
+            stats["count"] += 1
+            if started_at is not None:
+                stats["wait_seconds"] += started_at - submitted_at
+                stats["run_seconds"] += finished_at - started_at
+            stats["max_seconds"] = max(stats["max_seconds"], finished_at - submitted_at)
+
+    def metrics(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            # Submitted and not finished yet, and ones of them waiting for a free thread
+            "in_flight": self.in_flight,
+            "queue_depth": max(0, self.in_flight - self.max_workers),
+            "operations": {
+                operation: {
+                    "count": stats["count"],
+                    "avg_wait_ms": stats["wait_seconds"] / stats["count"] * 1000,
+                    "avg_run_ms": stats["run_seconds"] / stats["count"] * 1000,
+                    "max_latency_ms": stats["max_seconds"] * 1000,
+                }
+                for operation, stats in self.stats.items()
+            }
+        }
+
+
+image_pool = ImageProcessingPool(int(os.getenv("IMAGE_WORKERS", 4)))
 
 
 class ImageRepository:
     IMAGES_PATH = pathlib.Path(os.getenv("IMAGES_PATH", "images"))
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+    MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 50 * 1024 * 1024))
+    THUMBNAILS_PATH = IMAGES_PATH / "thumbnails"
+    THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 800))
 
-    def store(self, body: bytes, filename: str):
-        im = Image.open(BytesIO(body))
-        if not im.mode == "RGB":
-            im = im.convert("RGB")
-        im.save(self.IMAGES_PATH / filename, "JPEG")
+    async def spool(self, upload: UploadFile) -> tuple[str, str]:
+        """
+        Copy upload to the images volume by chunks, hashing it on the fly,
+        so the whole file is never held in memory.
+        File operations run in the image pool, so a slow volume doesn't block the event loop.
+        Return spooled filename and sha256 of the content
+        """
+        spool_filename = f"{uuid4()}.upload"
+        path = self.IMAGES_PATH / spool_filename
+        image_hash = hashlib.sha256()
+        size = 0
+        try:
+            f = await image_pool.run("spool", open, path, "wb")
+            try:
+                while chunk := await upload.read(self.UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.MAX_UPLOAD_SIZE:
+                        raise HTTPException(413, detail=f"File {upload.filename} is too large")
+                    image_hash.update(chunk)
+                    await image_pool.run("spool", f.write, chunk)
+            finally:
+                await image_pool.run("spool", f.close)
+            await image_pool.run("spool", self._check_image, path)
+        except UnidentifiedImageError:
+            path.unlink(missing_ok=True)
+            raise HTTPException(422, detail=f"File {upload.filename} is not an image")
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        return spool_filename, image_hash.hexdigest()
 
-    def get(self, filename: str) -> BytesIO:
+    @staticmethod
+    def _check_image(path: pathlib.Path):
+        # Only the header is parsed here, pixels are decoded on store
+        with Image.open(path):
+            pass
+
+    def discard(self, spool_filename: str):
+        (self.IMAGES_PATH / spool_filename).unlink(missing_ok=True)
+
+    async def store(self, spool_filename: str, filename: str):
+        """
+        Save spooled upload by filename as upright RGB JPEG.
+        Baseline RGB JPEGs without rotation are moved as is, other images are transcoded
+        """
+        await image_pool.run("store", self._store, spool_filename, filename)
+
+    def _store(self, spool_filename: str, filename: str):
+        path = self.IMAGES_PATH / spool_filename
+        try:
+            with Image.open(path) as im:
+                orientation = im.getexif().get(ExifTags.Base.Orientation, 1)
+                if im.format == "JPEG" and im.mode == "RGB" and orientation == 1 and not im.info.get("progressive"):
+                    os.replace(path, self.IMAGES_PATH / filename)
+                    return
+                im = ImageOps.exif_transpose(im)
+                if not im.mode == "RGB":
+                    im = im.convert("RGB")
+                im.save(self.IMAGES_PATH / filename, "JPEG")
+        finally:
+            path.unlink(missing_ok=True)
+
+    async def read(self, filename: str, max_size: int) -> bytes | None:
+        """Stored image bytes, None if the image is larger than max_size"""
+        return await image_pool.run("read", self._read, filename, max_size)
+
+    def _read(self, filename: str, max_size: int) -> bytes | None:
+        path = self.IMAGES_PATH / filename
+        if path.stat().st_size > max_size:
+            return None
+        return path.read_bytes()
+
+    async def get(self, filename: str) -> BytesIO:
+        return await image_pool.run("get", self._get, filename)
+
+    def _get(self, filename: str) -> BytesIO:
         with open(self.IMAGES_PATH / filename, 'rb') as f:
             return BytesIO(f.read())
 
-    def draw_rect(self, buffer: BytesIO, rect: tuple[int, int, int, int]) -> BytesIO:
-        im = Image.open(buffer)
-        draw = ImageDraw.Draw(im)
-        draw.rectangle((rect[:2], rect[2:]), outline="green", width=7)
-        new_buffer = BytesIO()
-        im.save(new_buffer, 'png')
-        return new_buffer
+    def thumbnail_path(self, item_id: int) -> pathlib.Path:
+        return self.THUMBNAILS_PATH / f"{item_id}.jpg"
+
+    async def create_thumbnail(self, filename: str, item_id: int, rect: tuple[int, int, int, int] | None):
+        """Save downscaled copy of the image with the face rect (left, top, right, bottom) drawn on it"""
+        await self.create_thumbnails(filename, [(item_id, rect)])
+
+    async def create_thumbnails(self, filename: str, items: list[tuple[int, tuple[int, int, int, int] | None]]):
+        """Save thumbnails of several (item id, face rect) of one image, decoding the image once"""
+        await image_pool.run("thumbnail", self._create_thumbnails, filename, items)
 
+    def _create_thumbnails(self, filename: str, items: list[tuple[int, tuple[int, int, int, int] | None]]):
+        with Image.open(self.IMAGES_PATH / filename) as im:
+            width, height = im.size
+            im.draft("RGB", (self.THUMBNAIL_SIZE, self.THUMBNAIL_SIZE))
+            im.thumbnail((self.THUMBNAIL_SIZE, self.THUMBNAIL_SIZE))
+            scale = im.width / width
+            self.THUMBNAILS_PATH.mkdir(exist_ok=True)
+            for item_id, rect in items:
+                thumbnail = im
+                if rect is not None:
+                    thumbnail = im.copy()
+                    draw = ImageDraw.Draw(thumbnail)
+                    draw.rectangle(
+                        [int(i * scale) for i in rect], outline="green", width=max(2, int(7 * scale))
+                    )
+                # Write to a temporary file first, so a half-written thumbnail is never served.
+                # The name is unique, as the thumbnail may be created on request at the same time
+                path = self.thumbnail_path(item_id)
+                tmp_path = path.with_suffix(f".{uuid4().hex}.tmp")
+                thumbnail.save(tmp_path, "JPEG", quality=80)
+                os.replace(tmp_path, path)
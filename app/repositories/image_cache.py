@@ -0,0 +1,105 @@
+import asyncio
+import datetime as dt
+import os
+
+from loguru import logger
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy_service import BaseService as BaseRepository
+
+from app.db.tables import ImageCache
+from app.schemas.cv import CVResponse
+
+
+def _utcnow() -> dt.datetime:
+    return dt.datetime.now(dt.UTC).replace(tzinfo=None)
+
+
+class ImageCacheRepository[Table: ImageCache, str](BaseRepository):
+    """
+    Image hash -> CV response cache with TTL and LRU eviction.
+    Entry is reserved before sending the image to cv worker
+    and filled by its filename when the response arrives.
+    """
+    base_table = ImageCache
+
+    TTL = dt.timedelta(seconds=int(os.getenv("IMAGE_CACHE_TTL", 7 * 24 * 3600)))
+    MAX_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", 100000))
+
+    async def get_many(self, image_hashes: list[str]) -> dict[str, list[CVResponse]]:
+        """Fresh cached responses by image hash, marking them as used"""
+        if not image_hashes:
+            return {}
+        query = (
+            update(ImageCache)
+            .where(
+                ImageCache.hash.in_(set(image_hashes)),
+                ImageCache.response.is_not(None),
+                ImageCache.created_at >= _utcnow() - self.TTL
+            )
+            .values(used_at=_utcnow())
+            .returning(ImageCache.hash, ImageCache.response)
+        )
+        rows = (await self.session.execute(query)).all()
+        await self._commit()
+        return {
+            image_hash: [CVResponse.model_validate(face) for face in response]
+            for image_hash, response in rows
+        }
+
+    async def reserve_many(self, filenames: dict[str, str]):
+        """Create or reset entries of image hash -> filename to be filled by its response"""
+        if not filenames:
+            return
+        query = insert(ImageCache).values([
+            {"hash": image_hash, "filename": filename} for image_hash, filename in filenames.items()
+        ])
+        query = query.on_conflict_do_update(
+            index_elements=[ImageCache.hash],
+            set_={
+                "filename": query.excluded.filename,
+                "response": None,
+                "created_at": _utcnow(),
+                "used_at": _utcnow()
+            }
+        )
+        await self.session.execute(query)
+        await self._commit()
+
+    async def fill_many(self, responses: list[list[CVResponse]]):
+        """
+        Fill reserved entries by responses filenames in one transaction.
+        Responses with processing errors are not cached, so a transient failure isn't served for other uploads
+        """
+        for response in responses:
+            if any(face.error not in (None, CVResponse.FACE_NOT_FOUND) for face in response):
+                continue
+            query = (
+                update(ImageCache)
+                .where(ImageCache.filename == response[0].filename, ImageCache.response.is_(None))
+                .values(response=[face.model_dump() for face in response], created_at=_utcnow())
+            )
+            await self.session.execute(query)
+        await self._commit()
+
+    async def evict(self):
+        await self.session.execute(delete(ImageCache).where(ImageCache.created_at < _utcnow() - self.TTL))
+        oldest_kept = (
+            select(ImageCache.used_at)
+            .order_by(ImageCache.used_at.desc())
+            .offset(self.MAX_SIZE)
+            .limit(1)
+            .scalar_subquery()
+        )
+        await self.session.execute(delete(ImageCache).where(ImageCache.used_at <= oldest_kept))
+        await self._commit()
+
+    @classmethod
+    async def run_eviction(cls, interval: float = 600):
+        while True:
+            try:
+                async with cls() as repository:
+                    await repository.evict()
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,54 @@
+import datetime as dt
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy_service import BaseService as BaseRepository
+
+from app.db.tables import StatsHourly
+
+
+def current_hour() -> dt.datetime:
+    return to_hour(dt.datetime.now(dt.UTC))
+
+
+def to_utc(value: dt.datetime) -> dt.datetime:
+    """Naive UTC datetime as stored in the tables, naive values are taken as UTC already"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(dt.UTC).replace(tzinfo=None)
+
+
+def to_hour(value: dt.datetime) -> dt.datetime:
+    return to_utc(value).replace(minute=0, second=0, microsecond=0)
+
+
+def increment_query(hour: dt.datetime | None = None, **counters: int):
+    """Upsert adding counters to the hour row, None if there is nothing to add"""
+    counters = {name: value for name, value in counters.items() if value}
+    if not counters:
+        return None
+    query = insert(StatsHourly).values(hour=hour or current_hour(), **counters)
+    return query.on_conflict_do_update(
+        index_elements=[StatsHourly.hour],
+        set_={name: getattr(StatsHourly, name) + query.excluded[name] for name in counters}
+    )
+
+
+class StatsRepository[Table: StatsHourly, datetime](BaseRepository):
+    base_table = StatsHourly
+
+    async def increment(self, hour: dt.datetime | None = None, **counters: int):
+        """Add counters to the hour row in one upsert, creating the row if needed"""
+        query = increment_query(hour, **counters)
+        if query is None:
+            return
+        await self.session.execute(query)
+        await self._commit()
+
+    async def list(self, hour_from: dt.datetime, hour_to: dt.datetime) -> list[StatsHourly]:
+        query = (
+            select(StatsHourly)
+            .where(StatsHourly.hour >= hour_from, StatsHourly.hour < hour_to)
+            .order_by(StatsHourly.hour)
+        )
+        return list((await self.session.scalars(query)).all())
@@ -1,9 +1,14 @@
+from collections import Counter
+from collections.abc import Callable
 from loguru import logger
 from sqlalchemy_service import BaseService as BaseRepository
-from sqlalchemy import exc
+from sqlalchemy import case, exc, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
 from uuid import UUID
+import datetime as dt
 
-from app.db.tables import Task, TaskItem
+from app.db.tables import Task, TaskItem, TaskStatus
+from app.repositories.stats import increment_query
 
 
 class TaskRepository[Table: Task, int](BaseRepository):
@@ -42,14 +47,82 @@ class TaskRepository[Table: Task, int](BaseRepository):
         self.response.status_code = 201
         return await self.get(model.id)
 
+    async def create_many(self, models: list[Task]) -> list[UUID]:
+        self.session.add_all(models)
+        await self.session.flush()
+        ids = [model.id for model in models]
+        await self._commit()
+        return ids
+
     async def create_items(self, *models: TaskItem):
         [self.session.add(model) for model in models]
         await self._commit()
 
+    async def create_images_items(
+            self, items: list[dict], count_stats: Callable[[list[TaskItem]], dict[str, int]] | None = None
+    ) -> tuple[list[TaskItem], dict[UUID, tuple[str, int, int]]]:
+        """
+        Insert items of several processed images with one multi-row INSERT,
+        count the images as done by task and add stats counters of the created items, all in one transaction.
+        Items of already saved images, e.g. from a redelivered response, conflict on the face index
+        and are skipped, so the image isn't saved and counted twice.
+        Return created items and task status, done and total images count by task id
+        """
+        task_items = []
+        if items:
+            query = (
+                insert(TaskItem)
+                .on_conflict_do_nothing(index_elements=[TaskItem.task_id, TaskItem.image_index, TaskItem.face_index])
+                .returning(TaskItem)
+            )
+            task_items = list((await self.session.scalars(query, items)).all())
+        images_done = Counter(task_id for task_id, _ in {(item.task_id, item.image_index) for item in task_items})
+
+        progress = {}
+        # Rows are locked in the same order by all concurrent batches, so they can't deadlock
+        for task_id, count in sorted(images_done.items()):
+            done = Task.images_done + count
+            query = (
+                update(Task)
+                .where(Task.id == task_id)
+                .values(
+                    images_done=done,
+                    status=case(
+                        (Task.status == TaskStatus.failed.value, TaskStatus.failed.value),
+                        (done >= Task.images_count, TaskStatus.finished.value),
+                        else_=TaskStatus.processing.value
+                    )
+                )
+                .returning(Task.status, Task.images_done, Task.images_count)
+            )
+            progress[task_id] = tuple((await self.session.execute(query)).one())
+        if count_stats is not None and (query := increment_query(**count_stats(task_items))) is not None:
+            await self.session.execute(query)
+        await self._commit()
+        return task_items, progress
+
     async def list(self, page=None, count=None) -> list[Task]:
         logger.debug(self.engine.pool_size)
         return list(await self._get_list(page=page, count=count, select_in_load=Task.items))
 
+    async def list_short(
+            self, count: int, after: tuple[dt.datetime, UUID] | None = None, status: str | None = None
+    ) -> list:
+        """
+        Page of tasks columns without items, newest first.
+        Keyset pagination: after is (created_at, id) of the last task of the previous page
+        """
+        query = (
+            select(Task.id, Task.created_at, Task.error, Task.status, Task.images_count, Task.images_done)
+            .order_by(Task.created_at.desc(), Task.id.desc())
+            .limit(count)
+        )
+        if after is not None:
+            query = query.where(tuple_(Task.created_at, Task.id) < after)
+        if status is not None:
+            query = query.where(Task.status == status)
+        return list((await self.session.execute(query)).all())
+
     async def get(self, model_id: UUID) -> Task:
         return await self._get_one(
             id=model_id,
@@ -0,0 +1,58 @@
+import asyncio
+from collections import defaultdict
+import json
+
+from aio_pika import ExchangeType, Message
+from loguru import logger
+
+from app.db.rabbitmq import channel_pool
+
+
+class TaskEventsRepository:
+    """
+    Broadcasts saved task items to every API worker through a fanout exchange.
+    Each worker listens with its own exclusive queue
+    and dispatches events to local subscribers of the task.
+    """
+    EXCHANGE_NAME = "task_events"
+
+    _subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    @classmethod
+    def subscribe(cls, task_id) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        cls._subscribers[str(task_id)].add(queue)
+        return queue
+
+    @classmethod
+    def unsubscribe(cls, task_id, queue: asyncio.Queue):
+        subscribers = cls._subscribers.get(str(task_id))
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del cls._subscribers[str(task_id)]
+
+    @classmethod
+    async def publish(cls, task_id, items: list[dict], **progress):
+        body = json.dumps({"task_id": str(task_id), "items": items, **progress})
+        async with channel_pool.acquire() as channel:
+            exchange = await channel.declare_exchange(cls.EXCHANGE_NAME, ExchangeType.FANOUT)
+            await exchange.publish(Message(body=body.encode()), routing_key="")
+
+    @classmethod
+    async def listen(cls):
+        async with channel_pool.acquire() as channel:
+            exchange = await channel.declare_exchange(cls.EXCHANGE_NAME, ExchangeType.FANOUT)
+            queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+            await queue.bind(exchange)
+
+            async with queue.iterator(no_ack=True) as queue_iter:
+                async for message in queue_iter:
+                    if not cls._subscribers:
+                        continue
+                    event = json.loads(message.body)
+                    subscribers = cls._subscribers.get(event["task_id"], ())
+                    logger.debug(f"Task {event['task_id']} event for {len(subscribers)} subscribers")
+                    for subscriber in subscribers:
+                        subscriber.put_nowait(event)
@@ -1,6 +1,11 @@
+from fastapi import HTTPException
+from sqlalchemy import select, update
 from sqlalchemy_service import BaseService as BaseRepository
+from uuid import UUID
+import datetime as dt
 
-from app.db.tables import TaskItem
+from app.db.tables import Task, TaskItem
+from app.repositories.stats import increment_query
 
 
 class TaskItemRepository[Table: TaskItem, int](BaseRepository):
@@ -15,11 +20,72 @@ class TaskItemRepository[Table: TaskItem, int](BaseRepository):
     async def list(self, page=None, count=None) -> list[TaskItem]:
         return list(await self._get_list(page=page, count=count))
 
+    async def list_short_by_tasks(self, task_ids: list[UUID]) -> list:
+        """Columns of the tasks items needed for the short representation"""
+        if not task_ids:
+            return []
+        query = (
+            select(
+                TaskItem.id, TaskItem.task_id, TaskItem.left_eye_close, TaskItem.right_eye_close,
+                TaskItem.is_eyes_closed, TaskItem.is_face_small, TaskItem.with_glasses, TaskItem.is_profile,
+                TaskItem.is_halfprofile, TaskItem.image_index, TaskItem.error, TaskItem.is_good
+            )
+            .where(TaskItem.task_id.in_(task_ids))
+            .order_by(TaskItem.id)
+        )
+        return list((await self.session.execute(query)).all())
+
+    async def list_filtered(
+            self,
+            count: int,
+            before_id: int | None = None,
+            created_from: dt.datetime | None = None,
+            created_to: dt.datetime | None = None,
+            **flags: bool
+    ) -> list[TaskItem]:
+        """Items by persisted flag values and their task creation time, newest first"""
+        query = select(TaskItem).order_by(TaskItem.id.desc()).limit(count)
+        for name, value in flags.items():
+            query = query.where(getattr(TaskItem, name) == value)
+        if before_id is not None:
+            query = query.where(TaskItem.id < before_id)
+        if created_from is not None or created_to is not None:
+            query = query.join(Task, Task.id == TaskItem.task_id)
+            if created_from is not None:
+                query = query.where(Task.created_at >= created_from)
+            if created_to is not None:
+                query = query.where(Task.created_at < created_to)
+        return list((await self.session.scalars(query)).all())
+
     async def get(self, model_id: int) -> TaskItem:
         return await self._get_one(
             id=model_id,
         )
 
+    async def vote(self, model_id: int, value: bool):
+        """
+        Set the item vote and count the change from the previous one in the stats rollup, in one transaction,
+        so re-voting isn't counted twice
+        """
+        old = select(TaskItem.id, TaskItem.is_good).where(TaskItem.id == model_id).with_for_update().subquery()
+        query = (
+            update(TaskItem)
+            .where(TaskItem.id == old.c.id)
+            .values(is_good=value)
+            .returning(old.c.id, old.c.is_good)
+        )
+        row = (await self.session.execute(query)).one_or_none()
+        if row is None:
+            raise HTTPException(404, detail="Task item not found")
+        previous = row.is_good
+        query = increment_query(
+            votes_good=int(value is True) - int(previous is True),
+            votes_bad=int(value is False) - int(previous is False)
+        )
+        if query is not None:
+            await self.session.execute(query)
+        await self._commit()
+
     async def update(self, model_id: int, **fields) -> TaskItem:
         return await self._update(model_id, **fields)
 
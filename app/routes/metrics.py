@@ -0,0 +1,13 @@
+import os
+from fastapi import APIRouter
+
+from app.repositories.image import image_pool
+
+
+router = APIRouter(prefix="/api/metrics", tags=["Metrics"])
+
+
+@router.get("/image-pool")
+async def get_image_pool_metrics():
+    """Image processing pool metrics of the gunicorn worker that served the request"""
+    return {"pid": os.getpid(), **image_pool.metrics()}
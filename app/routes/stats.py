@@ -0,0 +1,18 @@
+import datetime as dt
+from fastapi import APIRouter, Depends
+
+from app.schemas.stats import StatsReportSchema
+from app.services.stats import StatsService
+
+
+router = APIRouter(prefix="/api/stats", tags=["Statistics"])
+
+
+@router.get("", response_model=StatsReportSchema)
+async def get_stats(
+        hour_from: dt.datetime | None = None,
+        hour_to: dt.datetime | None = None,
+        service: StatsService = Depends()
+):
+    """Per-hour counters of tasks, faces and votes (UTC), last 24 hours by default"""
+    return await service.get(hour_from, hour_to)
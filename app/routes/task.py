@@ -1,8 +1,10 @@
-from fastapi import APIRouter, BackgroundTasks, Depends, File, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Form, HTTPException, Query, UploadFile
+import json
+from fastapi.responses import StreamingResponse
 from uuid import UUID
 
 from app.repositories.cv import CVRepository
-from app.schemas.task import TaskSchema
+from app.schemas.task import TaskBatchSchema, TaskItemFilterSchema, TaskItemListSchema, TaskListSchema, TaskSchema
 from app.services.task import TaskService
 from . import validate_api_token
 
@@ -17,16 +19,99 @@ async def create_validation_task(
         cv_repository: CVRepository = Depends(),
         service: TaskService = Depends(TaskService)
 ):
-    model = await service.create()
-    for i, f in enumerate(file):
-        background_tasks.add_task(service.send, model.id, await f.read(), i, cv_repository)
+    await cv_repository.admit()
+    spooled = await service.upload(file)
+    model = await service.create(images_count=len(file))
+    for i, (spool_filename, image_hash) in enumerate(spooled):
+        background_tasks.add_task(service.send, model.id, spool_filename, image_hash, i, cv_repository)
     return model
 
 
+def _parse_manifest(manifest: str | None, files_count: int) -> list[list[int]]:
+    if manifest is None:
+        return [[i] for i in range(files_count)]
+    try:
+        tasks = json.loads(manifest)
+    except ValueError:
+        tasks = None
+    # bool is excluded too, as well as floats like 1.0 that compare equal to indexes
+    if not isinstance(tasks, list) or not all(
+            isinstance(task, list) and all(type(i) is int for i in task) for task in tasks
+    ):
+        raise HTTPException(422, detail="Manifest must be a JSON list of file indexes lists")
+    indexes = sorted(i for task in tasks for i in task)
+    if indexes != list(range(files_count)) or not all(tasks):
+        raise HTTPException(422, detail="Manifest must use every file index exactly once, tasks can't be empty")
+    return tasks
+
+
+@router.post("/batch", response_model=TaskBatchSchema, status_code=201)
+async def create_validation_tasks(
+        background_tasks: BackgroundTasks,
+        file: list[UploadFile],
+        manifest: str | None = Form(
+            None, description="JSON list of tasks as lists of file indexes, e.g. [[0, 1], [2]]. "
+                              "One task per file by default"
+        ),
+        cv_repository: CVRepository = Depends(),
+        service: TaskService = Depends(TaskService)
+):
+    """Create many tasks in one transaction, ids are returned in the manifest order"""
+    tasks = _parse_manifest(manifest, len(file))
+    await cv_repository.admit(bulk=True)
+    spooled = await service.upload(file)
+    ids = await service.create_many([len(task) for task in tasks])
+    images = [
+        (task_id, *spooled[file_index], image_index)
+        for task_id, task in zip(ids, tasks)
+        for image_index, file_index in enumerate(task)
+    ]
+    background_tasks.add_task(service.send_many, images, cv_repository, bulk=True)
+    return TaskBatchSchema(ids=ids)
+
+
+@router.get("", response_model=TaskListSchema)
+async def list_tasks(
+        count: int = Query(50, ge=1, le=500),
+        cursor: str | None = Query(None, description="next_cursor of the previous page"),
+        status: str | None = None,
+        service: TaskService = Depends(TaskService)
+):
+    return await service.get_list(count=count, cursor=cursor, status=status)
+
+
+@router.get("/items", response_model=TaskItemListSchema)
+async def search_task_items(
+        filters: TaskItemFilterSchema = Depends(),
+        service: TaskService = Depends(TaskService)
+):
+    """Faces by flags and task creation time, e.g. ?is_profile=true&is_eyes_closed=true&created_from=..."""
+    return await service.search_items(filters)
+
+
 @router.get("/{task_id}")
 async def get_task_status(
         task_id: UUID,
+        wait: float = Query(0, ge=0, le=60, description="Seconds to hold the request until results arrive"),
         service: TaskService = Depends(TaskService)
 ):
+    if wait:
+        return await service.wait(task_id, wait)
     return await service.get(task_id)
 
+
+
+@router.get("/{task_id}/events")
+async def stream_task_events(
+        task_id: UUID,
+        service: TaskService = Depends(TaskService)
+):
+    """
+    Server-Sent Events: "task" with the current state, "items" with progress for every saved image result
+    and "completed" when the task is finished
+    """
+    return StreamingResponse(
+        await service.stream(task_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,11 +1,9 @@
 from uuid import UUID
 from fastapi import APIRouter, Depends, Request, Query
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
 from loguru import logger
-from base64 import b64encode
 
-from app.repositories.image import ImageRepository
 from app.services.task import TaskService
 
 router = APIRouter(prefix="/panel")
@@ -15,30 +13,40 @@ templates = Jinja2Templates(directory="templates")
 @router.get("", response_class=HTMLResponse)
 async def index_page(
         request: Request,
+        cursor: str | None = None,
         task_service: TaskService = Depends()
 ):
-    tasks = await task_service.get_list()
-    return templates.TemplateResponse("index.html", {"request": request, "tasks": tasks})
+    page = await task_service.get_list(count=100, cursor=cursor)
+    return templates.TemplateResponse(
+        "index.html", {"request": request, "tasks": page.tasks, "next_cursor": page.next_cursor}
+    )
 
 
 @router.get("/{task_id}", response_class=HTMLResponse)
 async def details_page(
         request: Request,
         task_id: UUID,
-        task_service: TaskService = Depends(),
-        image_repository: ImageRepository = Depends()
+        task_service: TaskService = Depends()
 ):
     model = await task_service.get(task_id)
-    images = []
-    for item in model.items:
-        image_buffer = image_repository.get(str(model.id) + ":" + str(item.image_index))
-        if item.face_left is not None:
-            image_buffer = image_repository.draw_rect(
-                image_buffer, (item.face_left, item.face_top, item.face_right, item.face_bottom)
-            )
-        image_encoded = b64encode(image_buffer.getvalue()).decode("utf-8")
-        images.append(image_encoded)
-    return templates.TemplateResponse("details.html", {"request": request, "task": model, "images": images})
+    return templates.TemplateResponse("details.html", {"request": request, "task": model})
+
+
+@router.get("/{task_id}/images/{item_id}")
+async def item_thumbnail(
+        request: Request,
+        task_id: UUID,
+        item_id: int,
+        task_service: TaskService = Depends()
+):
+    """Downscaled image of the item with the face rect drawn. Thumbnails never change once created"""
+    path = await task_service.get_item_thumbnail(task_id, item_id)
+    stat = path.stat()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
 
 
 @router.post("/{task_id}/vote/{item_id}")
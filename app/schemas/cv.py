@@ -1,7 +1,12 @@
+from typing import ClassVar
+
 from pydantic import BaseModel
 
 
 class CVResponse(BaseModel):
+    # The only error that is a result of the image, others are processing failures
+    FACE_NOT_FOUND: ClassVar[str] = "Face not found"
+
     filename: str
     task_id: str
     left_eye_close: float | None = None
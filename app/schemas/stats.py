@@ -0,0 +1,56 @@
+import datetime as dt
+from pydantic import BaseModel, ConfigDict, computed_field
+
+
+class StatsSchema(BaseModel):
+    tasks: int = 0
+    images: int = 0
+    faces: int = 0
+    faces_not_found: int = 0
+    processing_failed: int = 0
+    eyes_closed: int = 0
+    small_faces: int = 0
+    profile: int = 0
+    halfprofile: int = 0
+    glasses: int = 0
+    votes_good: int = 0
+    votes_bad: int = 0
+
+    def _rate(self, value: int) -> float | None:
+        return value / self.faces if self.faces else None
+
+    @computed_field
+    @property
+    def eyes_closed_rate(self) -> float | None:
+        return self._rate(self.eyes_closed)
+
+    @computed_field
+    @property
+    def profile_rate(self) -> float | None:
+        return self._rate(self.profile)
+
+    @computed_field
+    @property
+    def halfprofile_rate(self) -> float | None:
+        return self._rate(self.halfprofile)
+
+    @computed_field
+    @property
+    def glasses_rate(self) -> float | None:
+        return self._rate(self.glasses)
+
+    @computed_field
+    @property
+    def face_not_found_rate(self) -> float | None:
+        return self.faces_not_found / self.images if self.images else None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class StatsHourSchema(StatsSchema):
+    hour: dt.datetime
+
+
+class StatsReportSchema(BaseModel):
+    hours: list[StatsHourSchema]
+    total: StatsSchema
@@ -1,5 +1,7 @@
+import datetime as dt
 from uuid import UUID
-from pydantic import BaseModel, ConfigDict, computed_field
+from typing import ClassVar
+from pydantic import BaseModel, ConfigDict, Field, computed_field, field_validator
 
 
 class TaskItemShortSchema(BaseModel):
@@ -22,10 +24,19 @@ class TaskShortSchema(BaseModel):
     id: UUID
     items: list[TaskItemShortSchema]
     error: str | None = None
+    created_at: dt.datetime | None = None
+    status: str | None = None
+    images_count: int | None = None
+    images_done: int | None = None
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class TaskListSchema(BaseModel):
+    tasks: list[TaskShortSchema]
+    next_cursor: str | None = None
+
+
 class TaskItemSchema(BaseModel):
     id: int | None = None
     left_eye_close: float | None = None
@@ -85,6 +96,43 @@ class TaskSchema(BaseModel):
     id: UUID
     items: list[TaskItemSchema]
     error: str | None = None
+    status: str | None = None
+    images_count: int | None = None
+    images_done: int | None = None
 
     model_config = ConfigDict(from_attributes=True)
 
+
+
+class TaskItemListSchema(BaseModel):
+    items: list[TaskItemSchema]
+    next_before_id: int | None = None
+
+
+class TaskItemFilterSchema(BaseModel):
+    FLAGS: ClassVar[tuple[str, ...]] = (
+        "is_eyes_closed", "is_face_small", "is_profile", "is_halfprofile", "with_glasses", "is_good"
+    )
+
+    is_eyes_closed: bool | None = None
+    is_face_small: bool | None = None
+    is_profile: bool | None = None
+    is_halfprofile: bool | None = None
+    with_glasses: bool | None = None
+    is_good: bool | None = None
+    created_from: dt.datetime | None = None
+    created_to: dt.datetime | None = None
+    before_id: int | None = Field(None, description="next_before_id of the previous page")
+    count: int = Field(100, ge=1, le=1000)
+
+    @field_validator("created_from", "created_to")
+    @classmethod
+    def to_naive_utc(cls, value: dt.datetime | None) -> dt.datetime | None:
+        """Tasks creation time is stored as naive UTC, naive values are taken as UTC already"""
+        if value is None or value.tzinfo is None:
+            return value
+        return value.astimezone(dt.UTC).replace(tzinfo=None)
+
+
+class TaskBatchSchema(BaseModel):
+    ids: list[UUID]
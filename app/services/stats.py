@@ -0,0 +1,22 @@
+import datetime as dt
+from fastapi import Depends
+
+from app.repositories.stats import StatsRepository, current_hour, to_hour
+from app.schemas.stats import StatsHourSchema, StatsReportSchema, StatsSchema
+
+
+class StatsService:
+    def __init__(self, stats_repository: StatsRepository = Depends()):
+        self.stats_repository = stats_repository
+
+    async def get(self, hour_from: dt.datetime | None = None, hour_to: dt.datetime | None = None) -> StatsReportSchema:
+        """Hourly rollups of the range, last 24 hours by default, and their sum"""
+        hour_to = to_hour(hour_to) if hour_to else current_hour() + dt.timedelta(hours=1)
+        hour_from = to_hour(hour_from) if hour_from else hour_to - dt.timedelta(hours=24)
+        models = await self.stats_repository.list(hour_from, hour_to)
+        hours = [StatsHourSchema.model_validate(model) for model in models]
+        total = StatsSchema(**{
+            name: sum(getattr(hour, name) for hour in hours)
+            for name in StatsSchema.model_fields
+        })
+        return StatsReportSchema(hours=hours, total=total)
@@ -1,52 +1,208 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict
+from collections.abc import AsyncIterator
+import datetime as dt
 from uuid import UUID
-from fastapi import Depends
+from fastapi import Depends, HTTPException, UploadFile
+import asyncio
+import json
+import pathlib
 from loguru import logger
 
-from app.db.tables import Task, TaskItem
+from app.db.tables import Task, TaskItem, TaskStatus
 from app.repositories.image import ImageRepository
 from app.repositories.cv import CVRepository
+from app.repositories.image_cache import ImageCacheRepository
+from app.repositories.stats import StatsRepository
 from app.repositories.task import TaskRepository
+from app.repositories.task_events import TaskEventsRepository
 from app.repositories.task_item import TaskItemRepository
 from app.schemas.cv import CVResponse
-from app.schemas.task import TaskItemSchema, TaskItemShortSchema, TaskSchema, TaskShortSchema
+from app.schemas.task import (
+    TaskItemFilterSchema, TaskItemListSchema, TaskItemSchema, TaskItemShortSchema,
+    TaskListSchema, TaskSchema, TaskShortSchema
+)
 
 
 class TaskService:
+    # The event loop keeps only weak references to tasks
+    _thumbnail_tasks: set[asyncio.Task] = set()
+
     def __init__(
             self,
             task_repository: TaskRepository = Depends(),
             task_item_repository: TaskItemRepository = Depends(),
+            image_cache_repository: ImageCacheRepository = Depends(),
+            stats_repository: StatsRepository = Depends(),
     ):
         self.task_repository = task_repository
         self.task_item_repository = task_item_repository
+        self.image_cache_repository = image_cache_repository
+        self.stats_repository = stats_repository
         self.image_repository = ImageRepository()
 
     async def item_vote(self, item_id: int, value: bool):
-        await self.task_item_repository.update(item_id, is_good=value)
+        await self.task_item_repository.vote(item_id, value)
+
+    async def create(self, images_count: int = 0) -> TaskSchema:
+        model = Task(images_count=images_count)
+        model = await self.task_repository.create(model)
+        await self.stats_repository.increment(tasks=1, images=images_count)
+        return model
+
+    @staticmethod
+    def _encode_cursor(created_at: dt.datetime, task_id: UUID) -> str:
+        return urlsafe_b64encode(f"{created_at.isoformat()}|{task_id}".encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple[dt.datetime, UUID]:
+        try:
+            created_at, task_id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return dt.datetime.fromisoformat(created_at), UUID(task_id)
+        except ValueError:
+            raise HTTPException(422, detail="Invalid cursor")
+
+    async def get_list(self, count: int = 100, cursor: str | None = None, status: str | None = None) -> TaskListSchema:
+        """Page of tasks, newest first, with only the fields of the short representation"""
+        after = self._decode_cursor(cursor) if cursor else None
+        tasks = await self.task_repository.list_short(count, after=after, status=status)
+        items = await self.task_item_repository.list_short_by_tasks([task.id for task in tasks])
+
+        items_by_task = defaultdict(list)
+        for item in items:
+            items_by_task[item.task_id].append(TaskItemShortSchema.model_validate(item))
+        schemas = [
+            TaskShortSchema.model_validate({**task._asdict(), "items": items_by_task[task.id]})
+            for task in tasks
+        ]
+        next_cursor = None
+        if len(tasks) == count:
+            next_cursor = self._encode_cursor(tasks[-1].created_at, tasks[-1].id)
+        return TaskListSchema(tasks=schemas, next_cursor=next_cursor)
 
-    async def create(self) -> TaskSchema:
-        model = Task()
-        return await self.task_repository.create(model)
+    async def search_items(self, filters: TaskItemFilterSchema) -> TaskItemListSchema:
+        """Items matching the persisted flags and task creation time, newest first"""
+        models = await self.task_item_repository.list_filtered(
+            count=filters.count,
+            before_id=filters.before_id,
+            created_from=filters.created_from,
+            created_to=filters.created_to,
+            **filters.model_dump(include=set(TaskItemFilterSchema.FLAGS), exclude_none=True)
+        )
+        items = [TaskItemSchema.model_validate(model) for model in models]
+        next_before_id = items[-1].id if len(items) == filters.count else None
+        return TaskItemListSchema(items=items, next_before_id=next_before_id)
 
-    async def get_list(self, count: int = 100, page: int = 0) -> list[TaskShortSchema]:
-        models = await self.task_repository.list(page=page, count=count)
-        return [TaskShortSchema.model_validate(model) for model in models]
+    async def upload(self, files: list[UploadFile]) -> list[tuple[str, str]]:
+        """Spool uploaded files to the images volume. Return spooled filenames with content hashes"""
+        spooled = []
+        try:
+            for file in files:
+                spooled.append(await self.image_repository.spool(file))
+        except BaseException:
+            for spool_filename, _ in spooled:
+                self.image_repository.discard(spool_filename)
+            raise
+        return spooled
+
+    async def create_many(self, images_counts: list[int]) -> list[UUID]:
+        """Create tasks in one transaction. Return their ids in the same order"""
+        ids = await self.task_repository.create_many([Task(images_count=count) for count in images_counts])
+        await self.stats_repository.increment(tasks=len(ids), images=sum(images_counts))
+        return ids
+
+    async def send(
+            self, task_id: UUID, spool_filename: str, image_hash: str, image_index: int, cv_repository: CVRepository
+    ):
+        await self.send_many([(task_id, spool_filename, image_hash, image_index)], cv_repository)
 
-    async def send(self, task_id: UUID, image_raw: bytes, image_index: int, cv_repository: CVRepository):
-        image_filename = f"{task_id}:{image_index}"
-        self.image_repository.store(image_raw, image_filename)
+    async def send_many(
+            self, images: list[tuple[UUID, str, str, int]], cv_repository: CVRepository, bulk: bool = False
+    ):
+        """
+        Store (task id, spooled filename, hash, image index) images and answer cached ones right away.
+        The rest is published to cv worker as one pipelined batch, to the bulk lane if bulk is set
+        """
+        filenames = [f"{task_id}:{image_index}" for task_id, _, _, image_index in images]
+        stored = await asyncio.gather(
+            *(
+                self.image_repository.store(spool_filename, filename)
+                for (_, spool_filename, _, _), filename in zip(images, filenames)
+            ),
+            return_exceptions=True
+        )
+        failed_tasks: dict[UUID, str] = {}
+        pending = []
+        for (task_id, _, image_hash, _), filename, result in zip(images, filenames, stored):
+            if isinstance(result, Exception):
+                logger.exception(result)
+                failed_tasks[task_id] = str(result)
+                continue
+            pending.append((task_id, image_hash, filename))
 
         try:
-            await cv_repository.process_image(image_filename, str(task_id))
+            cached = await self.image_cache_repository.get_many([image_hash for _, image_hash, _ in pending])
         except Exception as e:
+            # Cache is an optimization, without it all images are sent to cv worker
             logger.exception(e)
-            await self.task_repository.update(task_id, error=str(e))
-            return
+            cached = {}
+        hits, misses = [], []
+        for task_id, image_hash, filename in pending:
+            if image_hash not in cached:
+                misses.append((task_id, image_hash, filename))
+                continue
+            logger.debug(f"Cache hit for {filename}")
+            hits.append([
+                face.model_copy(update={"filename": filename, "task_id": str(task_id)})
+                for face in cached[image_hash]
+            ])
+        if hits:
+            try:
+                await self._save_cv_responses(hits)
+            except Exception as e:
+                logger.exception(e)
+                failed_tasks.update((UUID(response[0].task_id), str(e)) for response in hits)
 
-    async def _save_cv_response(self, response: list[CVResponse]):
-        if not response:
-            return
-        task_items = [
+        semaphore = asyncio.Semaphore(cv_repository.SEND_CONCURRENCY)
+
+        async def send(task_id: UUID, filename: str):
+            # Each image is read right before its publish, so at most SEND_CONCURRENCY images are held in memory
+            async with semaphore:
+                try:
+                    image = None
+                    if cv_repository.INLINE_MAX_SIZE:
+                        image = await self.image_repository.read(filename, cv_repository.INLINE_MAX_SIZE)
+                    await cv_repository.send(filename, str(task_id), image, bulk=bulk)
+                except Exception as e:
+                    # Only tasks with not confirmed requests are failed, the others get their results
+                    logger.opt(exception=e).error(f"Publish of task {task_id} image failed")
+                    failed_tasks[task_id] = str(e)
+
+        try:
+            await self.image_cache_repository.reserve_many(
+                {image_hash: filename for _, image_hash, filename in misses}
+            )
+        except Exception as e:
+            logger.exception(e)
+            failed_tasks.update((task_id, str(e)) for task_id, _, _ in misses)
+        else:
+            await asyncio.gather(*(send(task_id, filename) for task_id, _, filename in misses))
+        for task_id, error in failed_tasks.items():
+            await self._fail_task(task_id, error)
+
+    async def _fail_task(self, task_id: UUID, error: str):
+        """Mark the task failed and notify its waiting clients, so their streams and long polls complete"""
+        model = await self.task_repository.update(task_id, error=error, status=TaskStatus.failed.value)
+        try:
+            await TaskEventsRepository.publish(
+                task_id, [], status=model.status, images_done=model.images_done, images_count=model.images_count
+            )
+        except Exception as e:
+            logger.exception(e)
+
+    @staticmethod
+    def _build_items(response: list[CVResponse]) -> list[TaskItemSchema]:
+        return [
             (
                 TaskItemSchema(left_eye_close=face.left_eye_close, right_eye_close=face.right_eye_close,
                            face_left=face.face_location[3], face_top=face.face_location[0],
@@ -60,17 +216,204 @@ class TaskService:
             )
             for face in response
         ]
-        task_items = [TaskItem(**schema.model_dump()) for schema in task_items]
-        logger.debug(f"Saving {len(task_items)} items")
-        await self.task_repository.create_items(*task_items)
+
+    @staticmethod
+    def _count_stats(stats: dict[str, int], schemas: list[TaskItem | TaskItemSchema]):
+        """Add counters of one image results to the stats rollup"""
+        errors = {schema.error for schema in schemas if schema.error is not None}
+        if errors == {CVResponse.FACE_NOT_FOUND}:
+            stats["faces_not_found"] += 1
+            return
+        if errors:
+            stats["processing_failed"] += 1
+            return
+        stats["faces"] += len(schemas)
+        for schema in schemas:
+            stats["eyes_closed"] += bool(schema.is_eyes_closed)
+            stats["small_faces"] += bool(schema.is_face_small)
+            stats["profile"] += bool(schema.is_profile)
+            stats["halfprofile"] += bool(schema.is_halfprofile)
+            stats["glasses"] += bool(schema.with_glasses)
+
+    @classmethod
+    def _count_items_stats(cls, items: list[TaskItem]) -> dict[str, int]:
+        """Stats counters of created items, by image"""
+        images = defaultdict(list)
+        for item in items:
+            images[(item.task_id, item.image_index)].append(item)
+        stats = defaultdict(int)
+        for image_items in images.values():
+            cls._count_stats(stats, image_items)
+        return stats
+
+    async def _save_cv_response(self, response: list[CVResponse]):
+        await self._save_cv_responses([response])
+
+    async def _save_cv_responses(self, responses: list[list[CVResponse]]):
+        """
+        Save items, tasks progress and stats for several images in one transaction.
+        Cache fill and events follow and only log their errors.
+        Thumbnails are created in the background, so they hold back neither the events nor the ack
+        """
+        responses = [response for response in responses if response]
+        if not responses:
+            return
+        rows = []
+        for response in responses:
+            # Computed flags (is_eyes_closed, is_face_small, ...) are dumped too and persisted for filtering in SQL
+            rows += [
+                {**schema.model_dump(exclude={"id"}), "face_index": face_index}
+                for face_index, schema in enumerate(self._build_items(response))
+            ]
+        logger.debug(f"Saving {len(rows)} items of {len(responses)} images")
+        task_items, progress = await self.task_repository.create_images_items(rows, self._count_items_stats)
+
+        # Responses are saved at this point, so the rest is best effort and must not fail the batch
+        try:
+            await self.image_cache_repository.fill_many(responses)
+        except Exception as e:
+            logger.exception(e)
+
+        items_by_task = defaultdict(list)
+        for item in task_items:
+            items_by_task[item.task_id].append(TaskItemSchema.model_validate(item).model_dump(mode="json"))
+        for task_id, items in items_by_task.items():
+            status, done, total = progress[task_id]
+            try:
+                await TaskEventsRepository.publish(
+                    task_id, items, status=status, images_done=done, images_count=total
+                )
+            except Exception as e:
+                logger.exception(e)
+
+        # Items of one image share a thumbnail decode
+        images = defaultdict(list)
+        for item in task_items:
+            images[f"{item.task_id}:{item.image_index}"].append((item.id, self._face_rect(item)))
+        task = asyncio.create_task(self._create_thumbnails(images))
+        self._thumbnail_tasks.add(task)
+        task.add_done_callback(self._thumbnail_tasks.discard)
+
+    @staticmethod
+    def _face_rect(item: TaskItem | TaskItemSchema) -> tuple[int, int, int, int] | None:
+        if item.face_left is None:
+            return None
+        return item.face_left, item.face_top, item.face_right, item.face_bottom
+
+    async def _create_thumbnails(self, images: dict[str, list[tuple[int, tuple[int, int, int, int] | None]]]):
+        async def create(filename: str, items: list[tuple[int, tuple[int, int, int, int] | None]]):
+            try:
+                await self.image_repository.create_thumbnails(filename, items)
+            except Exception as e:
+                logger.exception(e)
+
+        await asyncio.gather(*(create(filename, items) for filename, items in images.items()))
+
+    async def _create_thumbnail(self, item: TaskItem | TaskItemSchema):
+        try:
+            await self.image_repository.create_thumbnail(
+                f"{item.task_id}:{item.image_index}", item.id, self._face_rect(item)
+            )
+        except Exception as e:
+            logger.exception(e)
+
+    async def get_item_thumbnail(self, task_id: UUID, item_id: int) -> pathlib.Path:
+        """
+        Return path to the item thumbnail, creating it if it is missing:
+        for items saved before thumbnails were introduced or not processed in the background yet
+        """
+        item = TaskItemSchema.model_validate(await self.task_item_repository.get(item_id))
+        if str(item.task_id) != str(task_id):
+            raise HTTPException(404)
+        path = self.image_repository.thumbnail_path(item_id)
+        if not path.exists():
+            await self._create_thumbnail(item)
+            if not path.exists():
+                raise HTTPException(404)
+        return path
 
     async def get(self, task_id: UUID) -> TaskSchema:
         model = await self.task_repository.get(task_id)
         return TaskSchema.model_validate(model)
 
+    @staticmethod
+    def _is_completed(model: TaskSchema) -> bool:
+        return model.status in (TaskStatus.finished.value, TaskStatus.failed.value)
+
+    @staticmethod
+    def _apply_event(model: TaskSchema, event: dict) -> TaskSchema:
+        # Items saved between the subscription and the task fetch are already in the model
+        known_ids = {item.id for item in model.items}
+        items = [TaskItemSchema.model_validate(item) for item in event["items"] if item["id"] not in known_ids]
+        return model.model_copy(update={
+            "items": model.items + items,
+            "status": event["status"],
+            "images_done": event["images_done"],
+            "images_count": event["images_count"],
+        })
+
+    async def wait(self, task_id: UUID, timeout: float) -> TaskSchema:
+        """Return the task as soon as it is completed, holding up to timeout seconds for its results"""
+        events = TaskEventsRepository.subscribe(task_id)
+        try:
+            model = await self.get(task_id)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while not self._is_completed(model):
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                model = self._apply_event(model, event)
+            return model
+        finally:
+            TaskEventsRepository.unsubscribe(task_id, events)
+
+    async def stream(self, task_id: UUID, keepalive_interval: float = 15) -> AsyncIterator[str]:
+        """
+        Subscribe to the task events and return Server-Sent Events stream,
+        starting with the current task state, then new items as they are saved.
+        The stream ends with "completed" event once all task images are processed
+        """
+        events = TaskEventsRepository.subscribe(task_id)
+        try:
+            model = await self.get(task_id)
+        except Exception:
+            TaskEventsRepository.unsubscribe(task_id, events)
+            raise
+        return self._stream_events(task_id, model, events, keepalive_interval)
+
     @classmethod
-    async def save_cv_response(cls, response: list[CVResponse]):
-        async with TaskRepository() as task_repository:
-            self = cls(task_repository=task_repository)
-            await self._save_cv_response(response)
+    async def _stream_events(
+            cls, task_id: UUID, model: TaskSchema, events: asyncio.Queue, keepalive_interval: float
+    ) -> AsyncIterator[str]:
+        try:
+            yield f"event: task\ndata: {model.model_dump_json()}\n\n"
+            while not cls._is_completed(model):
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                model = cls._apply_event(model, event)
+                # The event dict is shared by all subscribers of the task, so it's not modified
+                data = {key: value for key, value in event.items() if key != "task_id"}
+                yield f"event: items\ndata: {json.dumps(data)}\n\n"
+            yield f"event: completed\ndata: {json.dumps({'status': model.status})}\n\n"
+        finally:
+            TaskEventsRepository.unsubscribe(task_id, events)
+
+    @classmethod
+    async def save_cv_responses(cls, responses: list[list[CVResponse]]):
+        async with (
+            TaskRepository() as task_repository,
+            ImageCacheRepository() as image_cache_repository,
+            StatsRepository() as stats_repository,
+        ):
+            self = cls(
+                task_repository=task_repository,
+                image_cache_repository=image_cache_repository,
+                stats_repository=stats_repository
+            )
+            await self._save_cv_responses(responses)
 
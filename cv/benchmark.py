@@ -0,0 +1,91 @@
+"""Latency vs. accuracy of downscale-before-detect.
+
+Usage: python3 benchmark.py <fixtures directory> [max sides, e.g. 640,960,1280]
+
+Every image of the directory is recognized at full resolution (reference)
+and with each max side. For each setting prints mean latency per image,
+share of faces found compared to reference, mean face box IoU and
+mean absolute error of eyes closeness and rotation.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+import cv
+
+
+def box_iou(a, b) -> float:
+    # Boxes are in face_recognition format: top, right, bottom, left
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def run(filenames: list[str], max_side: int):
+    cv.max_side = max_side
+    results = []
+    start_time = time.perf_counter()
+    for filename in filenames:
+        results.append(cv.recognize(filename, "benchmark"))
+    return results, (time.perf_counter() - start_time) / len(filenames)
+
+
+def compare(reference, results) -> dict:
+    found, ious, eye_errors, rotation_errors = 0, [], [], []
+    total = 0
+    for reference_faces, faces in zip(reference, results):
+        reference_faces = [face for face in reference_faces if face.error is None]
+        faces = [face for face in faces if face.error is None]
+        total += len(reference_faces)
+        for reference_face in reference_faces:
+            if not faces:
+                break
+            face = max(faces, key=lambda f: box_iou(f.face_location, reference_face.face_location))
+            iou = box_iou(face.face_location, reference_face.face_location)
+            if iou < 0.5:
+                continue
+            found += 1
+            ious.append(iou)
+            eye_errors.append(abs(face.left_eye_close - reference_face.left_eye_close))
+            eye_errors.append(abs(face.right_eye_close - reference_face.right_eye_close))
+            rotation_errors.append(abs(face.rotation - reference_face.rotation))
+    return {
+        "found": found / total if total else 1.0,
+        "iou": float(np.mean(ious)) if ious else 0.0,
+        "eye_mae": float(np.mean(eye_errors)) if eye_errors else 0.0,
+        "rotation_mae": float(np.mean(rotation_errors)) if rotation_errors else 0.0,
+    }
+
+
+def main():
+    directory = sys.argv[1]
+    max_sides = [int(i) for i in sys.argv[2].split(",")] if len(sys.argv) > 2 else [480, 640, 960, 1280, 1920]
+    cv.images_directory = os.path.join(directory, "")
+    filenames = sorted(
+        name for name in os.listdir(directory)
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
+    )
+    if not filenames:
+        sys.exit("No images found in " + directory)
+
+    run(filenames[:1], 0)  # Warm up
+    reference, reference_latency = run(filenames, 0)
+    print(f"{'max side':>10} {'ms/image':>10} {'found':>8} {'iou':>8} {'eye mae':>8} {'rot mae':>8}")
+    print(f"{'full':>10} {reference_latency * 1000:>10.1f} {1:>8.3f} {1:>8.3f} {0:>8.4f} {0:>8.4f}")
+    for max_side in max_sides:
+        results, latency = run(filenames, max_side)
+        stats = compare(reference, results)
+        print(
+            f"{max_side:>10} {latency * 1000:>10.1f} {stats['found']:>8.3f} {stats['iou']:>8.3f} "
+            f"{stats['eye_mae']:>8.4f} {stats['rotation_mae']:>8.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
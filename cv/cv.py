@@ -1,20 +1,64 @@
-from io import BytesIO
 import math
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import aio_pika
 import face_alignment
 import cv2
 import pika
-from scipy.spatial import distance as dist
 import dataclasses
+from io import BytesIO
 import json
 from PIL import Image
 import numpy as np
-from typing import Union, List
+from typing import Union, List, Tuple
 import collections
+import contextlib
+import gc
+import hashlib
+import signal
+import sys
+import time
+import traceback
 import torch
 
 images_directory = "images/"
 rabbitmq_host = os.getenv("RABBITMQ_HOST")
+# Interactive requests lane and bulk lane, served only when the interactive one is empty
+interactive_queue = "cv_requests"
+bulk_queue = "cv_requests_bulk"
+# Requests that failed max_retries times or can't be parsed, kept for inspection
+dead_letter_queue = "cv_requests_dead"
+max_retries = int(os.getenv("CV_MAX_RETRIES", 3))
+# Processing time limit per image in seconds, 0 disables it
+message_timeout = float(os.getenv("CV_MESSAGE_TIMEOUT", 60))
+# Up to batch_size requests are collected, waiting at most batch_timeout seconds for the batch to fill
+batch_size = int(os.getenv("CV_BATCH_SIZE", 1))
+batch_timeout = int(os.getenv("CV_BATCH_TIMEOUT_MS", 50)) / 1000
+# Number of forked consumer processes and unacknowledged messages each of them may hold
+workers_count = int(os.getenv("CV_WORKERS", 1))
+prefetch_count = int(os.getenv("CV_PREFETCH", 2 * batch_size))
+# Dead consumer is restarted after restart_delay seconds, doubled up to restart_max_delay on repeated crashes
+restart_delay = float(os.getenv("CV_RESTART_DELAY", 1))
+restart_max_delay = 60
+# Images with a longer side are downscaled to it before detection, 0 disables downscaling
+max_side = int(os.getenv("CV_MAX_SIDE", 0))
+if batch_size > 1 and not max_side:
+    # Only images of the same shape are batched, which original photos rarely share,
+    # and full resolution batches take too much memory
+    print("[!] CV_BATCH_SIZE needs CV_MAX_SIDE, images are processed one by one")
+    batch_size = 1
+# Run the asyncio pipeline consumer instead of the blocking one, with decode_threads decoding images
+pipeline = bool(os.getenv("CV_PIPELINE"))
+decode_threads = int(os.getenv("CV_DECODE_THREADS", 2))
+# Created once the model is warmed up and the consumer is connected, for the container health check
+ready_file = os.getenv("CV_READY_FILE", "/tmp/cv-ready")
+# Markers of requests being processed. A redelivered request with a marker was taken by a worker
+# that died processing it. The directory must be shared by all cv containers, it's on the images volume by default.
+# With a container local directory a request crashing workers of different containers isn't counted
+processing_directory = os.getenv("CV_PROCESSING_DIR", os.path.join(images_directory, "processing"))
+# Set by SIGTERM: the consumer finishes the current batch and exits
+stopping = False
 
 
 @dataclasses.dataclass
@@ -34,6 +78,8 @@ class Response:
 class Request:
     filename: str
     task_id: str
+    # Image bytes sent inline in the message, otherwise the image is read by filename from images_directory
+    image: Union[bytes, None] = dataclasses.field(default=None, repr=False)
 
 
 pred_types = {
@@ -73,109 +119,360 @@ class EnhancedJSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-def get_eye(eye):
-    # compute the euclidean distances between the two sets of
-    # vertical eye landmarks (x, y)-coordinates
-    A = dist.euclidean(eye[1], eye[5])
-    B = dist.euclidean(eye[2], eye[4])
+def define_glasses(img: np.ndarray, landmarks: np.ndarray) -> bool:
+    """Look for a glasses bridge edge between the eyebrows and the nose, landmarks are in img coordinates"""
+    height, width = img.shape[:2]
+    xmin = int(np.clip(landmarks[pred_types["nostril"], 0].min(), 0, width))
+    xmax = int(np.clip(landmarks[pred_types["nostril"], 0].max(), 0, width))
+    ymin = int(np.clip(landmarks[pred_types["face"], 1].min(), 0, height))
+    ymax = int(np.clip(landmarks[pred_types['nose'], 1].min(), 0, height))
+    if xmax <= xmin or ymax <= ymin:
+        return False
 
-    # compute the euclidean distance between the horizontal
-    # eye landmark (x, y)-coordinates
-    C = dist.euclidean(eye[0], eye[3])
+    crop = img[ymin:ymax, xmin:xmax]  # view, no copy
+    img_blur = cv2.GaussianBlur(crop, (3, 3), sigmaX=0, sigmaY=0)
+    edges = cv2.Canny(image=img_blur, threshold1=100, threshold2=200)
 
-    # compute the eye aspect ratio
-    eye = (A + B) / (2.0 * C)
+    edges_center = edges[:, edges.shape[1] // 2]
+
+    return bool((edges_center == 255).any())
+
+
+def face_geometry(landmarks: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Compute geometry for a (F, 68, 2) stack of faces landmarks at once.
+    Returns left and right eye aspect ratios, rotation (each of shape (F,))
+    and (F, 4) bounding boxes in face_recognition format: top, right, bottom, left.
+    If abs(rotation) > 0.17, then face is profile. If abs(rotation) > 0.045, then face is half-profile"""
+    # (2, F, 6, 2) stack of both eyes
+    eyes = np.stack((landmarks[:, pred_types["eye1"]], landmarks[:, pred_types["eye2"]]))
+    # the euclidean distances between the two sets of vertical eye landmarks
+    vertical = np.linalg.norm(eyes[..., [1, 2], :] - eyes[..., [5, 4], :], axis=-1).sum(axis=-1)
+    # the euclidean distance between the horizontal eye landmarks
+    horizontal = np.linalg.norm(eyes[..., 0, :] - eyes[..., 3, :], axis=-1)
+    eye_ratio = vertical / (2.0 * horizontal)
+
+    mins = landmarks.min(axis=1)
+    maxs = landmarks.max(axis=1)
+    face_points = landmarks[:, pred_types["face"]]
+    distance = np.linalg.norm(face_points[:, 0] - face_points[:, -1], axis=-1)
+    rotation = 1 - distance / (maxs[:, 0] - mins[:, 0])
+
+    boxes = np.stack((mins[:, 1], maxs[:, 0], maxs[:, 1], mins[:, 0]), axis=1)
+    return eye_ratio[0], eye_ratio[1], rotation, boxes
+
+
+def load_image(filename: str, image: Union[bytes, None] = None) -> Tuple[np.ndarray, Tuple[int, int], np.ndarray]:
+    """Decode image once for all analysis stages, limiting its longer side by max_side.
+    JPEGs are decoded straight at a reduced scale with draft() when downscaling.
+    Returns RGB image, original (height, width) and (x, y) scale factors from original coordinates to image ones"""
+    with Image.open(BytesIO(image) if image is not None else images_directory + filename) as im:
+        width, height = im.size
+        target = None
+        if max_side and max(width, height) > max_side:
+            ratio = max_side / max(width, height)
+            target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+            im.draft("RGB", target)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        if target is not None and im.size != target:
+            im = im.resize(target, Image.Resampling.BILINEAR)
+        img = np.asarray(im)
+    return img, (height, width), np.array([img.shape[1] / width, img.shape[0] / height])
+
+
+def build_responses(
+        filename: str, task_id: str, img: np.ndarray, image_size, face_landmarks_list, scale: np.ndarray
+) -> List[Response]:
+    """img is the decoded image landmarks were found on, image_size is the original image shape
+    and scale maps original coordinates to img ones"""
+    if face_landmarks_list is None or not len(face_landmarks_list):
+        return [Response(filename=filename, task_id=task_id, error="Face not found")]
 
-    # return the eye aspect ratio
-    return eye
+    landmarks = np.asarray(face_landmarks_list, dtype=np.float64).reshape(-1, 68, 2)
+    glasses = [define_glasses(img, landmark) for landmark in landmarks]
+    eyes_left, eyes_right, rotations, boxes = face_geometry(landmarks / scale)
 
+    responses = []
+    for eye_left, eye_right, rotation, box, with_glasses in zip(eyes_left, eyes_right, rotations, boxes, glasses):
+        responses.append(
+            Response(
+                filename=filename,
+                left_eye_close=float(eye_left),
+                right_eye_close=float(eye_right),
+                face_location=[int(i) for i in box],  # Response in face_recognition format
+                image_size=list(image_size[:2]),
+                glasses=with_glasses,
+                rotation=float(rotation),
+                task_id=task_id,
+            )
+        )
+    return responses
 
-def define_glasses(image_buffer: BytesIO, landmarks: np.ndarray):
-    xmin = min(landmarks[pred_types["nostril"]], key=lambda i: i[0])[0]
-    xmax = max(landmarks[pred_types["nostril"]], key=lambda i: i[0])[0]
-    ymin = min(landmarks[pred_types["face"]], key=lambda i: i[1])[1]
-    ymax = min(landmarks[pred_types['nose']], key=lambda i: i[1])[1]
 
-    img2 = Image.open(image_buffer)
-    img2 = img2.crop((xmin, ymin, xmax, ymax))
+def recognize(filename: str, task_id: str, image: Union[bytes, None] = None) -> List[Response]:
+    return infer([Request(filename=filename, task_id=task_id)], [load_image(filename, image)])[0]
 
-    img_blur = cv2.GaussianBlur(np.array(img2), (3, 3), sigmaX=0, sigmaY=0)
-    edges = cv2.Canny(image=img_blur, threshold1=100, threshold2=200)
 
-    edges_center = edges.T[(int(len(edges.T) / 2))]
+def recognize_batch(requests: List[Request]) -> List[List[Response]]:
+    return infer(requests, [load_image(request.filename, request.image) for request in requests])
 
-    return 255 in edges_center
 
+def infer(requests: List[Request], decoded: list) -> List[List[Response]]:
+    """Run face detection and landmarks for load_image results of the requests.
+    Images of the same shape are stacked into one model call, others are run alone:
+    padding them to a common size would change the scale and crop the detector sees,
+    making the results depend on the other images of the batch"""
+    groups = collections.defaultdict(list)
+    for i, (img, _, _) in enumerate(decoded):
+        groups[img.shape].append(i)
 
-def get_rotation(landmarks) -> float:
-    """if abs(rotation) > 0.17, then face is profile. If abs(rotation) > 0.045, then face is half-profile"""
-    face_points = landmarks[pred_types["face"]]
-    left = face_points[0]
-    right = face_points[-1]
-    width = (
-        max(landmarks, key=lambda i: i[0])[0] - min(landmarks, key=lambda i: i[0])[0]
-    )
+    landmarks = [None] * len(decoded)
+    for indexes in groups.values():
+        if len(indexes) == 1:
+            landmarks[indexes[0]] = detector.get_landmarks(decoded[indexes[0]][0])
+            continue
+        batch = np.stack([decoded[i][0] for i in indexes])
+        landmarks_batch = detector.get_landmarks_from_batch(torch.from_numpy(batch).permute(0, 3, 1, 2))
+        if landmarks_batch is not None:
+            for i, image_landmarks in zip(indexes, landmarks_batch):
+                landmarks[i] = image_landmarks
 
-    distance = ((left[0] - right[0]) ** 2 + (left[1] - right[1]) ** 2) ** 0.5
-    return 1 - distance / width
+    return [
+        build_responses(request.filename, request.task_id, img, image_size, image_landmarks, scale)
+        for request, (img, image_size, scale), image_landmarks in zip(requests, decoded, landmarks)
+    ]
 
 
-def recognize(filename: str, task_id: str) -> List[Response]:
-    responses = []
-    with open(images_directory + filename, "rb") as f:
-        buffer = BytesIO(f.read())
-    img = np.array(Image.open(buffer))
-    image_width, image_height, _ = img.shape
+class ProcessingTimeout(Exception):
+    pass
 
-    face_landmarks_list = detector.get_landmarks(img)
-    if not face_landmarks_list:
-        return [Response(filename=filename, task_id=task_id, error="Face not found")]
 
-    for landmark in face_landmarks_list:
-        left_eye = landmark[pred_types["eye1"]]
-        right_eye = landmark[pred_types["eye2"]]
+@contextlib.contextmanager
+def time_limit(seconds: float):
+    """Raise ProcessingTimeout in the main thread after seconds.
+    The alarm is handled between Python operations, so a running native call is finished first"""
+    if not seconds:
+        yield
+        return
 
-        left = min(landmark, key=lambda i: i[0])
-        right = max(landmark, key=lambda i: i[0])
-        top = min(landmark, key=lambda i: i[1])
-        bottom = max(landmark, key=lambda i: i[1])
+    def timeout(signum, frame):
+        raise ProcessingTimeout(f"Processing took longer than {seconds:g} s")
 
-        eye_left = get_eye(left_eye)
-        eye_right = get_eye(right_eye)
-        rotation = get_rotation(landmark)
-        responses.append(
-            Response(
-                filename=filename,
-                left_eye_close=float(eye_left),
-                right_eye_close=float(eye_right),
-                face_location=[
-                    int(top[1]),
-                    int(right[0]),
-                    int(bottom[1]),
-                    int(left[0]),
-                ],  # Response in face_recognition format
-                image_size=img.shape[:2],
-                glasses=False,
-                rotation=float(rotation),
-                task_id=task_id,
-            )
-        )
-    return responses
+    previous = signal.signal(signal.SIGALRM, timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def marker_path(request: Request) -> str:
+    return os.path.join(processing_directory, hashlib.sha1(request.filename.encode()).hexdigest())
+
+
+def mark_processing(requests: List[Request]):
+    for request in requests:
+        open(marker_path(request), "w").close()
+
+
+def unmark_processing(requests: List[Request]):
+    for request in requests:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(marker_path(request))
+
+
+def was_processing(request: Request) -> bool:
+    return os.path.exists(marker_path(request))
 
 
-def callback(ch, method, properties, body):
-    print("[*] Receive: " + str(body))
+def parse_request(body: bytes, properties) -> Union[Request, None]:
+    """Request is either JSON body or image body with filename and task_id in headers"""
     try:
-        request = Request(**json.loads(body))
+        if properties.content_type == "image/jpeg":
+            return Request(filename=properties.headers["filename"], task_id=properties.headers["task_id"], image=body)
+        return Request(**json.loads(body))
     except Exception:
-        return
-    responses = recognize(request.filename, request.task_id)
+        return None
+
+
+def response_body(responses: List[Response]) -> bytes:
     print("[*] Response: " + str(responses))
+    return json.dumps(responses, cls=EnhancedJSONEncoder).encode()
+
+
+def dead_letter_headers(headers: Union[dict, None], queue: str, error: str) -> dict:
+    print(f"[!] Dead letter: {error}")
+    return dict(headers or {}, **{"x-error": error, "x-queue": queue})
+
+
+def plan_failure(
+        headers: Union[dict, None], queue: str, request: Request, error: str
+) -> Tuple[List[Response], str, dict]:
+    """Decide what to do with a failed request, shared by both consumers.
+    A failed request is put back to the tail of its queue with the attempts counted in x-retries header.
+    After max_retries the task gets an error response and the request goes to the dead letter queue.
+    Returns error responses to publish (empty while retries are left),
+    queue and headers to republish the request with, the original message is acked after that"""
+    retries = (headers or {}).get("x-retries", 0) + 1
+    if retries > max_retries:
+        responses = [
+            Response(filename=request.filename, task_id=request.task_id, error=f"Image processing failed: {error}")
+        ]
+        return responses, dead_letter_queue, dead_letter_headers(headers, queue, error)
+    print(f"[!] Retry {retries} of {request}: {error}")
+    return [], queue, dict(headers or {}, **{"x-retries": retries})
+
+
+def publish(ch, reply_to: str, responses: List[Response]):
     ch.basic_publish(
         exchange="",
-        routing_key=properties.reply_to,
-        body=json.dumps(responses, cls=EnhancedJSONEncoder),
+        routing_key=reply_to,
+        body=response_body(responses),
+        properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
+    )
+
+
+def republish(ch, method, properties, body: bytes, routing_key: str, headers: dict):
+    ch.basic_publish(
+        exchange="",
+        routing_key=routing_key,
+        body=body,
+        properties=pika.BasicProperties(
+            content_type=properties.content_type,
+            reply_to=properties.reply_to,
+            headers=headers,
+            delivery_mode=pika.DeliveryMode.Persistent,
+        ),
+    )
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def dead_letter(ch, method, properties, body: bytes, error: str):
+    republish(
+        ch, method, properties, body, dead_letter_queue,
+        dead_letter_headers(properties.headers, method.routing_key, error)
+    )
+
+
+def retry(ch, method, properties, body: bytes, request: Request, error: str):
+    responses, routing_key, headers = plan_failure(properties.headers, method.routing_key, request, error)
+    if responses:
+        publish(ch, properties.reply_to, responses)
+    republish(ch, method, properties, body, routing_key, headers)
+    unmark_processing([request])
+
+
+async def publish_async(channel, reply_to: str, responses: List[Response]):
+    await channel.default_exchange.publish(
+        aio_pika.Message(body=response_body(responses), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+        routing_key=reply_to,
+    )
+
+
+async def republish_async(channel, message, routing_key: str, headers: dict):
+    await channel.default_exchange.publish(
+        aio_pika.Message(
+            body=message.body,
+            content_type=message.content_type,
+            reply_to=message.reply_to,
+            headers=headers,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        ),
+        routing_key=routing_key,
     )
+    await message.ack()
+
+
+async def dead_letter_async(channel, message, error: str):
+    await republish_async(
+        channel, message, dead_letter_queue, dead_letter_headers(message.headers, message.routing_key, error)
+    )
+
+
+async def retry_async(channel, message, request: Request, error: str):
+    responses, routing_key, headers = plan_failure(message.headers, message.routing_key, request, error)
+    if responses:
+        await publish_async(channel, message.reply_to, responses)
+    await republish_async(channel, message, routing_key, headers)
+    unmark_processing([request])
+
+
+def process_batch(ch, messages):
+    """Messages are acked only after their responses are published.
+    A failed batch is split and retried by single images to find the failing ones"""
+    requests, accepted = [], []
+    for method, properties, body in messages:
+        request = parse_request(body, properties)
+        print("[*] Receive: " + str(request))
+        if request is None:
+            dead_letter(ch, method, properties, body, "Malformed request")
+            continue
+        if method.redelivered and was_processing(request):
+            # Worker processing it died, e.g. killed for OOM. Count it as a failed attempt,
+            # so a request crashing the worker is dead-lettered instead of crash-looping it.
+            # Requests only prefetched by the worker are redelivered without the attempt counted
+            retry(ch, method, properties, body, request, "Worker died while processing")
+            continue
+        requests.append(request)
+        accepted.append((method, properties, body))
+    if not requests:
+        return
+    mark_processing(requests)
+    try:
+        with time_limit(message_timeout * len(requests)):
+            if len(requests) == 1:
+                results = [recognize(requests[0].filename, requests[0].task_id, requests[0].image)]
+            else:
+                results = recognize_batch(requests)
+    except Exception as e:
+        if len(requests) > 1:
+            # Redelivered messages of the batch must not be taken for crashed ones in the single image pass
+            unmark_processing(requests)
+            for message in accepted:
+                process_batch(ch, [message])
+            return
+        retry(ch, *accepted[0], requests[0], f"{type(e).__name__}: {e}")
+        return
+    for request, responses, (method, properties, _) in zip(requests, results, accepted):
+        publish(ch, properties.reply_to, responses)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        unmark_processing([request])
+
+
+def get_bulk_batch(channel) -> list:
+    """Fetch up to batch_size already waiting messages of the bulk lane"""
+    batch = []
+    while len(batch) < batch_size:
+        method, properties, body = channel.basic_get(bulk_queue)
+        if method is None:
+            break
+        batch.append((method, properties, body))
+    return batch
+
+
+def consume_batches(channel):
+    """Yield lists of up to batch_size messages, flushing a partial batch after batch_timeout.
+    Interactive requests go first, bulk lane is served only while there are no interactive ones.
+    Stops once stopping is set, messages of a partial batch are left unacked to be redelivered"""
+    batch = []
+    deadline = None
+    for method, properties, body in channel.consume(
+            interactive_queue, inactivity_timeout=batch_timeout
+    ):
+        if stopping:
+            return
+        if method is not None:
+            batch.append((method, properties, body))
+            if deadline is None:
+                deadline = time.monotonic() + batch_timeout
+        if batch and (method is None or len(batch) >= batch_size or time.monotonic() >= deadline):
+            yield batch
+            batch, deadline = [], None
+        elif method is None:
+            bulk_batch = get_bulk_batch(channel)
+            if bulk_batch:
+                yield bulk_batch
 
 
 def consume_json_messages():
@@ -183,17 +480,266 @@ def consume_json_messages():
     connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
     channel = connection.channel()
 
-    # Declare the same queue
-    channel.queue_declare(queue="cv_requests", durable=True)
-
-    # Set up the consumer
-    channel.basic_consume(
-        queue="cv_requests", on_message_callback=callback, auto_ack=True
-    )
+    # Declare the same queues
+    channel.queue_declare(queue=interactive_queue, durable=True)
+    channel.queue_declare(queue=bulk_queue, durable=True)
+    channel.queue_declare(queue=dead_letter_queue, durable=True)
+    channel.basic_qos(prefetch_count=max(prefetch_count, batch_size))
 
+    mark_ready()
+    print("Waiting for messages. To exit press CTRL+C")
+    for messages in consume_batches(channel):
+        process_batch(channel, messages)
+        if stopping:
+            break
+    # Prefetched messages are requeued by the broker as the channel closes
+    print("[*] Stopping")
+    channel.cancel()
+    connection.close()
+
+
+def stop(signum, frame):
+    global stopping
+    stopping = True
+
+
+async def consume_pipeline():
+    """Asyncio consumer with stages connected by bounded queues:
+    several decode tasks read and decode images in a thread pool, a single inference task
+    batches decoded images and runs the model in its own thread, and a publish task sends responses
+    and acks the messages. So reading and decoding of the next images overlaps with inference of the current batch.
+    Interactive lane messages are decoded before the bulk lane ones.
+
+    On SIGTERM the consumers are cancelled, messages not taken for processing yet are requeued
+    and the taken ones are finished before the connection is closed.
+
+    The inference thread can't be interrupted: after a timeout the messages are retried,
+    but the following batches wait until the stuck model call returns"""
+    loop = asyncio.get_running_loop()
+    decode_pool = ThreadPoolExecutor(decode_threads, thread_name_prefix="decode")
+    inference_pool = ThreadPoolExecutor(1, thread_name_prefix="inference")
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    connection = await aio_pika.connect_robust(host=rabbitmq_host)
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=max(prefetch_count, batch_size))
+    await channel.declare_queue(dead_letter_queue, durable=True)
+
+    # Unbounded, as the number of unacked messages held is already limited by prefetch
+    received = asyncio.PriorityQueue()
+    decoded = asyncio.Queue(maxsize=2 * batch_size)
+    inferred = asyncio.Queue(maxsize=2 * batch_size)
+    received_count = 0
+    # Messages taken by the decode stage, they are done once acked
+    taken = set()
+
+    def receiver(priority: int):
+        def receive(message):
+            nonlocal received_count
+            received_count += 1
+            received.put_nowait((priority, received_count, message))
+        return receive
+
+    consumers = []
+    for priority, queue_name in enumerate((interactive_queue, bulk_queue)):
+        queue = await channel.declare_queue(queue_name, durable=True)
+        consumers.append((queue, await queue.consume(receiver(priority))))
+
+    async def decode_stage():
+        nonlocal taken
+        while True:
+            _, _, message = await received.get()
+            taken = {message for message in taken if not message.processed}
+            taken.add(message)
+            request = parse_request(message.body, message)
+            print("[*] Receive: " + str(request))
+            if request is None:
+                await dead_letter_async(channel, message, "Malformed request")
+                continue
+            if message.redelivered and was_processing(request):
+                await retry_async(channel, message, request, "Worker died while processing")
+                continue
+            mark_processing([request])
+            try:
+                image = await loop.run_in_executor(decode_pool, load_image, request.filename, request.image)
+            except Exception as e:
+                await retry_async(channel, message, request, f"{type(e).__name__}: {e}")
+                continue
+            await decoded.put((message, request, image))
+
+    async def run_inference(batch: list):
+        messages, requests, images = (list(i) for i in zip(*batch))
+        try:
+            results = await asyncio.wait_for(
+                loop.run_in_executor(inference_pool, infer, requests, images),
+                timeout=message_timeout * len(batch) or None,
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    await run_inference([item])
+                return
+            await retry_async(channel, messages[0], requests[0], f"{type(e).__name__}: {e}")
+            return
+        for message, request, responses in zip(messages, requests, results):
+            await inferred.put((message, request, responses))
+
+    async def inference_stage():
+        while True:
+            batch = [await decoded.get()]
+            deadline = loop.time() + batch_timeout
+            while len(batch) < batch_size and (timeout := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(decoded.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            await run_inference(batch)
+
+    async def publish_stage():
+        while True:
+            message, request, responses = await inferred.get()
+            await publish_async(channel, message.reply_to, responses)
+            await message.ack()
+            unmark_processing([request])
+
+    mark_ready()
     print("Waiting for messages. To exit press CTRL+C")
-    channel.start_consuming()
+    stages = [
+        *(asyncio.create_task(decode_stage()) for _ in range(decode_threads)),
+        asyncio.create_task(inference_stage()),
+        asyncio.create_task(publish_stage()),
+    ]
+    stopped = asyncio.create_task(stop.wait())
+    await asyncio.wait([*stages, stopped], return_when=asyncio.FIRST_COMPLETED)
+    stopped.cancel()
+    for stage in stages:
+        if stage.done():
+            stage.result()
+
+    print("[*] Stopping")
+    for queue, consumer_tag in consumers:
+        await queue.cancel(consumer_tag)
+    while not received.empty():
+        _, _, message = received.get_nowait()
+        await message.nack(requeue=True)
+    while not all(message.processed for message in taken) and not any(stage.done() for stage in stages):
+        await asyncio.sleep(0.1)
+    for stage in stages:
+        stage.cancel()
+    await connection.close()
+
+
+def warm_up():
+    """Run the model on dummy images of the configured batch sizes before consuming,
+    so lazy CUDA/JIT initialisation and allocator growth are not paid by the first requests.
+    Blank images have no faces, so the landmarks network is run on synthetic face boxes as well"""
+    started = time.monotonic()
+    side = max_side or 640
+    img = np.zeros((side, side, 3), dtype=np.uint8)
+    decoded = (img, img.shape[:2], np.ones(2))
+    request = Request(filename="warmup", task_id="warmup")
+    box = [side / 4, side / 4, side * 3 / 4, side * 3 / 4, 1.0]
+    for size in sorted({1, batch_size}):
+        infer([request] * size, [decoded] * size)
+        detector.get_landmarks(img, detected_faces=[box] * size)
+    print(f"[*] Warmed up in {time.monotonic() - started:.1f} s")
+
+
+def mark_ready():
+    with open(ready_file, "w") as f:
+        f.write(str(os.getpid()))
+
+
+def consume():
+    os.makedirs(processing_directory, exist_ok=True)
+    warm_up()
+    if pipeline:
+        asyncio.run(consume_pipeline())
+    else:
+        signal.signal(signal.SIGTERM, stop)
+        consume_json_messages()
+
+
+def run_worker(threads: int):
+    torch.set_num_threads(threads)
+    status = 1
+    try:
+        consume()
+        status = 0
+    except BaseException:
+        # os._exit skips the interpreter's own reporting of the error
+        traceback.print_exc()
+    finally:
+        # Buffers aren't flushed by os._exit either
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def run_workers(count: int):
+    """Fork count consumers after the model is loaded, so the weights pages are shared copy-on-write.
+    Dead consumers are restarted after a delay, doubled while they keep dying soon after the start,
+    so a consumer failing at startup doesn't spin. SIGTERM is forwarded to all of them, and they are waited to finish
+    their current batches.
+    Each consumer warms the model up after the fork, as OpenMP thread pools don't survive it,
+    and the ready file is created by the first one ready"""
+    threads = max(1, (os.cpu_count() or 1) // count)
+    # Start time by pid
+    children = {}
+    terminating = False
+    delay = restart_delay
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Ctrl+C reaches the whole process group, the parent forwards it as SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            run_worker(threads)
+        children[pid] = time.monotonic()
+
+    def terminate(signum, frame):
+        nonlocal terminating
+        terminating = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    # Keep the garbage collector from touching (and so copying) the objects inherited by the children
+    gc.freeze()
+    for _ in range(count):
+        spawn()
+    print(f"[*] Started {count} workers with {threads} threads each")
+
+    while children:
+        pid, status = os.wait()
+        if pid not in children:
+            continue
+        started = children.pop(pid)
+        if terminating:
+            continue
+        # A consumer which has run longer than the longest delay is taken as healthy
+        if time.monotonic() - started > restart_max_delay:
+            delay = restart_delay
+        print(f"[!] Worker {pid} exited with status {status}, restarting in {delay:g}s")
+        time.sleep(delay)
+        delay = min(delay * 2, restart_max_delay)
+        if terminating:
+            continue
+        spawn()
 
 
 if __name__ == "__main__":
-    consume_json_messages()
+    # Left from the previous run of a restarted container
+    if os.path.exists(ready_file):
+        os.remove(ready_file)
+    if workers_count > 1 and not os.getenv("CPU"):
+        # CUDA context is already initialized by the detector and can't be used in forked processes
+        print("[!] CV_WORKERS is supported only in CPU mode, starting a single worker")
+        workers_count = 1
+    if workers_count > 1:
+        run_workers(workers_count)
+    else:
+        consume()
@@ -0,0 +1,222 @@
+"""Fault injection tests of the cv worker acks, retries and dead lettering.
+
+The model is replaced by a stand-in, recognition failures are injected by patching recognize functions,
+and the broker is an in-memory stand-in of the AMQP channel. Run with `python -m pytest cv`
+"""
+import collections
+import itertools
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("pika")
+pytest.importorskip("aio_pika")
+pytest.importorskip("cv2")
+
+
+@pytest.fixture(scope="module")
+def cv():
+    # The model is not needed, so it's not built
+    with mock.patch.dict(sys.modules, {"face_alignment": mock.MagicMock(), "torch": mock.MagicMock()}), \
+            mock.patch.dict(os.environ, {"CPU": "1"}):
+        sys.modules.pop("cv", None)
+        import cv
+    return cv
+
+
+class FakeChannel:
+    """Blocking channel stand-in: queues of (properties, body, redelivered) and unacked deliveries"""
+
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.unacked = {}
+        self.tags = itertools.count(1)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        assert exchange == ""
+        properties = properties or SimpleNamespace(content_type=None, reply_to=None, headers=None)
+        self.queues[routing_key].append((properties, body, False))
+
+    def basic_ack(self, delivery_tag):
+        del self.unacked[delivery_tag]
+
+    def deliver(self, queue: str, count: int = 1) -> list:
+        messages = []
+        while self.queues[queue] and len(messages) < count:
+            properties, body, redelivered = self.queues[queue].popleft()
+            tag = next(self.tags)
+            self.unacked[tag] = (queue, properties, body)
+            method = SimpleNamespace(delivery_tag=tag, routing_key=queue, redelivered=redelivered)
+            messages.append((method, properties, body))
+        return messages
+
+    def close(self):
+        """Connection is lost, unacked messages go back to their queues as redelivered"""
+        for queue, properties, body in reversed(list(self.unacked.values())):
+            self.queues[queue].appendleft((properties, body, True))
+        self.unacked.clear()
+
+    def responses(self) -> list:
+        return [json.loads(body) for _, body, _ in self.queues["cv_responses"]]
+
+
+class WorkerKilled(BaseException):
+    """Stands for the worker process killed in the middle of processing, e.g. for OOM"""
+
+
+def request(cv, filename: str):
+    body = json.dumps({"filename": filename, "task_id": "task"}).encode()
+    properties = cv.pika.BasicProperties(reply_to="cv_responses")
+    return properties, body, False
+
+
+def ok(filename, task_id, image=None):
+    return [{"filename": filename, "task_id": task_id}]
+
+
+@pytest.fixture
+def channel(cv, tmp_path, monkeypatch):
+    monkeypatch.setattr(cv, "processing_directory", str(tmp_path))
+    monkeypatch.setattr(cv, "max_retries", 2)
+    monkeypatch.setattr(cv, "message_timeout", 60)
+    return FakeChannel()
+
+
+def test_malformed_request_is_dead_lettered(cv, channel):
+    channel.queues["cv_requests"].append((cv.pika.BasicProperties(reply_to="cv_responses"), b"not json", False))
+
+    cv.process_batch(channel, channel.deliver("cv_requests"))
+
+    assert not channel.unacked
+    assert not channel.queues["cv_requests"]
+    [(properties, body, _)] = channel.queues["cv_requests_dead"]
+    assert body == b"not json"
+    assert properties.headers["x-error"] == "Malformed request"
+    assert not channel.responses()
+
+
+def test_crash_is_counted_on_redelivery(cv, channel, monkeypatch):
+    channel.queues["cv_requests"].append(request(cv, "task:0"))
+    monkeypatch.setattr(cv, "recognize", mock.Mock(side_effect=WorkerKilled))
+
+    with pytest.raises(WorkerKilled):
+        cv.process_batch(channel, channel.deliver("cv_requests"))
+    channel.close()
+
+    # The next worker counts the attempt and puts the request back with the retries header
+    monkeypatch.setattr(cv, "recognize", ok)
+    [message] = channel.deliver("cv_requests")
+    assert message[0].redelivered
+    cv.process_batch(channel, [message])
+    assert not channel.responses()
+    [(properties, _, redelivered)] = channel.queues["cv_requests"]
+    assert properties.headers["x-retries"] == 1
+    assert not redelivered
+
+    cv.process_batch(channel, channel.deliver("cv_requests"))
+    assert channel.responses() == [[{"filename": "task:0", "task_id": "task"}]]
+    assert not channel.unacked
+    assert not os.listdir(cv.processing_directory)
+
+
+def test_prefetched_request_redelivery_is_not_counted(cv, channel, monkeypatch):
+    channel.queues["cv_requests"].append(request(cv, "task:0"))
+    channel.deliver("cv_requests")
+    channel.close()
+    monkeypatch.setattr(cv, "recognize", ok)
+
+    cv.process_batch(channel, channel.deliver("cv_requests"))
+
+    assert channel.responses() == [[{"filename": "task:0", "task_id": "task"}]]
+    assert not channel.queues["cv_requests"]
+
+
+def test_exhausted_retries_are_dead_lettered(cv, channel, monkeypatch):
+    channel.queues["cv_requests"].append(request(cv, "task:0"))
+    recognize = mock.Mock(side_effect=MemoryError("too large"))
+    monkeypatch.setattr(cv, "recognize", recognize)
+
+    while channel.queues["cv_requests"]:
+        cv.process_batch(channel, channel.deliver("cv_requests"))
+
+    assert recognize.call_count == cv.max_retries + 1
+    assert not channel.unacked
+    [[response]] = channel.responses()
+    assert response["filename"] == "task:0"
+    assert response["error"] == "Image processing failed: MemoryError: too large"
+    [(properties, _, _)] = channel.queues["cv_requests_dead"]
+    assert properties.headers["x-retries"] == cv.max_retries
+    assert properties.headers["x-error"] == "MemoryError: too large"
+    assert properties.headers["x-queue"] == "cv_requests"
+
+
+def test_timeout_is_retried(cv, channel, monkeypatch):
+    channel.queues["cv_requests"].append(request(cv, "task:0"))
+    monkeypatch.setattr(cv, "message_timeout", 0.05)
+    monkeypatch.setattr(cv, "recognize", lambda *args: time.sleep(1))
+
+    started = time.monotonic()
+    cv.process_batch(channel, channel.deliver("cv_requests"))
+
+    assert time.monotonic() - started < 0.5
+    assert not channel.unacked
+    [(properties, _, _)] = channel.queues["cv_requests"]
+    assert properties.headers["x-retries"] == 1
+
+
+def test_failed_batch_is_split(cv, channel, monkeypatch):
+    for filename in ("task:0", "task:1", "task:2"):
+        channel.queues["cv_requests"].append(request(cv, filename))
+
+    def recognize(filename, task_id, image=None):
+        if filename == "task:1":
+            raise ValueError("broken image")
+        return ok(filename, task_id)
+
+    monkeypatch.setattr(cv, "recognize_batch", mock.Mock(side_effect=ValueError("broken image")))
+    monkeypatch.setattr(cv, "recognize", recognize)
+
+    cv.process_batch(channel, channel.deliver("cv_requests", count=3))
+
+    assert not channel.unacked
+    assert channel.responses() == [
+        [{"filename": "task:0", "task_id": "task"}],
+        [{"filename": "task:2", "task_id": "task"}],
+    ]
+    [(properties, body, _)] = channel.queues["cv_requests"]
+    assert json.loads(body)["filename"] == "task:1"
+    assert properties.headers["x-retries"] == 1
+
+
+def test_split_batch_of_redelivered_requests_is_not_counted(cv, channel, monkeypatch):
+    for filename in ("task:0", "task:1", "task:2"):
+        channel.queues["cv_requests"].append(request(cv, filename))
+    # Prefetched only, the connection was lost before they were processed
+    channel.deliver("cv_requests", count=3)
+    channel.close()
+
+    def recognize(filename, task_id, image=None):
+        if filename == "task:1":
+            raise ValueError("broken image")
+        return ok(filename, task_id)
+
+    monkeypatch.setattr(cv, "recognize_batch", mock.Mock(side_effect=ValueError("broken image")))
+    monkeypatch.setattr(cv, "recognize", recognize)
+
+    messages = channel.deliver("cv_requests", count=3)
+    assert all(method.redelivered for method, _, _ in messages)
+    cv.process_batch(channel, messages)
+
+    assert not channel.unacked
+    assert channel.responses() == [
+        [{"filename": "task:0", "task_id": "task"}],
+        [{"filename": "task:2", "task_id": "task"}],
+    ]
+    [(properties, body, _)] = channel.queues["cv_requests"]
+    assert json.loads(body)["filename"] == "task:1"
+    assert properties.headers["x-retries"] == 1